@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# benchmark for the tile colour classifiers: the nearest reference by the RGBI distance getSide uses
+# (colorDistance), in CIELAB through rgbi_to_lab and in HSV, each tile on its own and the whole cube
+# with classify, and how the quantized lookup table getSide tries first compares with colorDistance.
+#
+# scans come from the scans run_spike.py records, with the cube that was solved as the truth, or
+# from a generator with the brightness of every tile varying and red and orange close together.
+#
+# python3 bench_classifier.py -f ~/.cubebot/scans.jsonl
+
+import argparse, itertools, json, math, random, time
+from cube_colors import SENSOR_MAX, classify, distance2, rgbi_to_lab
+from cube_model import random_states
+from cube_symmetry import FACES
+import cube_model
+
+# buildColorLookup in cube_bot.py: 8 buckets of 128 per channel
+LOOKUP_SHIFT = 7
+LOOKUP_BUCKETS = 8
+
+# U R F D L B as the robot reads them: white, red, green, yellow, orange, blue
+REFERENCES = [(300, 300, 300, 900), (350, 60, 50, 400), (50, 300, 80, 350), (380, 350, 60, 700), (420, 150, 40, 500), (40, 80, 320, 380)]
+
+
+def hsv(rgbi):
+    # hue in degrees, saturation and value scaled so a full turn of hue weighs about as much as a channel
+    r, g, b = rgbi[:3]
+    high, low = max(r, g, b), min(r, g, b)
+    if high == low:
+        hue = 0
+    elif high == r:
+        hue = 60 * ((g - b) / (high - low) % 6)
+    elif high == g:
+        hue = 60 * ((b - r) / (high - low) + 2)
+    else:
+        hue = 60 * ((r - g) / (high - low) + 4)
+    return (hue, 360 * (high - low) / high if high else 0, 360 * high / SENSOR_MAX)
+
+
+def hsv_distance2(a, b):
+    hue = abs(a[0] - b[0]) % 360
+    return min(hue, 360 - hue) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+
+def color_distance(a, b):
+    # colorDistance on the hub
+    return math.sqrt(distance2(a, b))
+
+
+# name: (conversion, distance)
+SPACES = {
+    'rgbi colorDistance': (None, color_distance),
+    'lab': (rgbi_to_lab, distance2),
+    'hsv': (hsv, hsv_distance2),
+}
+
+
+def lookup_table(references):
+    # buildColorLookup: the nearest reference to the middle of every bucket
+    half = 1 << (LOOKUP_SHIFT - 1)
+    channels = [[[((bucket << LOOKUP_SHIFT) + half - ref[k]) ** 2 for ref in references] for bucket in range(LOOKUP_BUCKETS)] for k in range(4)]
+    table = bytearray(LOOKUP_BUCKETS ** 4)
+    for index, cell in enumerate(itertools.product(*channels)):
+        e = [sum(c[side] for c in cell) for side in range(6)]
+        table[index] = e.index(min(e))
+    return table
+
+
+def lookup_side(table, rgbi):
+    index = 0
+    for value in rgbi:
+        index = index * LOOKUP_BUCKETS + min(value >> LOOKUP_SHIFT, LOOKUP_BUCKETS - 1)
+    return table[index]
+
+
+def bench_lookup(scans):
+    # the table against colorDistance, getSide only falls back to it when no table is loaded
+    tiles = differ = wrong = exact_wrong = 0
+    tables = {}
+    start = time.perf_counter()
+    for readings, references, truth in scans:
+        key = tuple(map(tuple, references))
+        if key not in tables:
+            tables[key] = lookup_table(references)
+        table = tables[key]
+        for rgbi, face in zip(readings, truth):
+            side = lookup_side(table, rgbi)
+            exact = min(range(6), key=lambda s: color_distance(rgbi, references[s]))
+            differ += side != exact
+            wrong += FACES[side] != face
+            exact_wrong += FACES[exact] != face
+            tiles += 1
+    print("{:<20} {} byte table ({:.2f}s to build and check), {} of {} tiles wrong ({} with colorDistance), differs from colorDistance on {:.1%}, 0.0% fall back to it".format(
+        'rgbi lookup', LOOKUP_BUCKETS ** 4, time.perf_counter() - start, wrong, tiles, exact_wrong, differ / tiles))
+
+
+def synthetic_scans(count, noise, seed):
+    # (readings, references, cube) with every tile's brightness scaled by 0.7 to 1.2, sensor noise and
+    # now and then a tile under glare
+    rng = random.Random(seed)
+    scans = []
+    for cube in cube_model.decode(random_states(count, seed=seed)[0]):
+        readings = []
+        for i, face in enumerate(cube):
+            k = rng.uniform(0.7, 1.2)
+            reading = [min(SENSOR_MAX, max(0, round(c * k + rng.gauss(0, noise)))) for c in REFERENCES[FACES.index(face)]]
+            if i % 9 != 4 and rng.random() < 0.01:
+                reading = [min(SENSOR_MAX, c + 250) for c in reading]
+            readings.append(reading)
+        scans.append((readings, REFERENCES, cube))
+    return scans
+
+
+def recorded_scans(filename):
+    scans = []
+    with open(filename) as file:
+        for line in file:
+            scan = json.loads(line)
+            if scan.get('ref') and None not in scan['ref']:
+                scans.append((scan['rgbi'], scan['ref'], scan['solved']))
+    return scans
+
+
+def nearest(readings, references, space, distance):
+    if space is not None:
+        readings, references = [space(r) for r in readings], [space(r) for r in references]
+    return ''.join(FACES[min(range(6), key=lambda side: distance(rgbi, references[side]))] for rgbi in readings)
+
+
+def bench(scans, joint):
+    tiles = sum(len(readings) for readings, _, _ in scans)
+    for name, (space, distance) in SPACES.items():
+        start = time.perf_counter()
+        cubes = [nearest(readings, references, space, distance) for readings, references, _ in scans]
+        elapsed = time.perf_counter() - start
+        wrong = sum(a != b for cube, (_, _, truth) in zip(cubes, scans) for a, b in zip(cube, truth))
+        # red and orange read as each other
+        confused = sum({a, b} == {'R', 'L'} for cube, (_, _, truth) in zip(cubes, scans) for a, b in zip(cube, truth))
+        line = "{:<20} {:6.2f}us per tile, {:5} of {} tiles wrong ({} red/orange), {:.1%} of cubes right".format(
+            name, elapsed / tiles * 1e6, wrong, tiles, confused, sum(cube == truth for cube, (_, _, truth) in zip(cubes, scans)) / len(scans))
+        # classify compares squared distances, which the circular hue is not
+        if joint and space is not hsv:
+            right = sum(classify(readings, references, space)[0] == truth for readings, references, truth in scans)
+            line += ", {:.1%} with classify".format(right / len(scans))
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the tile colour classifiers')
+    parser.add_argument('-f', '--filename', help='Scans recorded by run_spike.py, one JSON object per line')
+    parser.add_argument('-n', '--count', help='Generated scans when no file is given', type=int, default=300)
+    parser.add_argument('--noise', help='Sensor noise of the generated scans', type=float, default=15)
+    parser.add_argument('--seed', help='Seed of the generated scans', type=int, default=1)
+    parser.add_argument('--no-joint', help='Skip classifying whole cubes, which is much slower', dest='joint', action='store_false')
+    args = parser.parse_args()
+
+    scans = recorded_scans(args.filename) if args.filename else synthetic_scans(args.count, args.noise, args.seed)
+    print("{} scans".format(len(scans)))
+    bench(scans, args.joint)
+    bench_lookup(scans)
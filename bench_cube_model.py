@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# benchmark for cube_model: checking one solution before it is sent, turning batches of states with
+# numpy and, with --solve, kociemba and the move compiler on random states checked in one batch
+
+import argparse, time
+import numpy as np
+import cube_model
+from cube_model import MOVE_NAMES, apply_solution, apply_solutions, check_solution, decode, encode, encode_solutions, random_states, solved_mask
+
+
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_check(cube, solution, repeat):
+    # a fresh solution is not in the permutation cache yet, time both cases
+    def uncached():
+        cube_model.solution_permutation.cache_clear()
+        check_solution(cube, solution)
+    print("check one solution: {:.1f}us, {:.1f}us with its permutation cached".format(
+        timed(uncached, repeat) * 1e6, timed(lambda: check_solution(cube, solution), repeat) * 1e6))
+
+
+def bench_batch(count, length):
+    start = time.perf_counter()
+    states, scrambles = random_states(count, length, seed=1)
+    elapsed = time.perf_counter() - start
+    print("scramble {} states by {} moves: {:.2f}s ({:.2f}M moves/s)".format(count, length, elapsed, count * length / elapsed / 1e6))
+
+    # undo every scramble in one batch, each state with its own inverse
+    inverse = {i: MOVE_NAMES.index(name[0] + {'': "'", '2': '2', "'": ''}[name[1:]]) for i, name in enumerate(MOVE_NAMES)}
+    undo = np.vectorize(inverse.get)(scrambles[:, ::-1])
+    start = time.perf_counter()
+    solved = solved_mask(apply_solutions(states, undo))
+    elapsed = time.perf_counter() - start
+    print("undo and check {} scrambles: {:.2f}s ({:.2f}M states/s), all solved: {}".format(count, elapsed, count / elapsed / 1e6, solved.all()))
+
+    # one solution applied to every state
+    solution = ' '.join(MOVE_NAMES[m] for m in scrambles[0][::-1])
+    start = time.perf_counter()
+    solved = solved_mask(apply_solution(states, solution))
+    elapsed = time.perf_counter() - start
+    print("one solution on {} states: {:.3f}s ({:.2f}M states/s), solved: {}".format(count, elapsed, count / elapsed / 1e6, solved.sum()))
+
+
+def bench_solve(count):
+    import kociemba
+    from robot_timing import default_model, plan_solution
+    cubes = decode(random_states(count, seed=2)[0])
+    start = time.perf_counter()
+    solutions = [kociemba.solve(cube) for cube in cubes]
+    solving = time.perf_counter() - start
+    start = time.perf_counter()
+    plans = [plan_solution(solution) for solution in solutions]
+    compiling = time.perf_counter() - start
+    start = time.perf_counter()
+    solved = solved_mask(apply_solutions(encode(cubes), encode_solutions(solutions)))
+    checking = time.perf_counter() - start
+    model = default_model()
+    print("{} random states: kociemba {:.1f}ms, compiler {:.1f}ms per state, est. {:.1f}s robot time, {} moves".format(
+        count, solving / count * 1000, compiling / count * 1000, sum(map(model.seconds, plans)) / count,
+        sum(len(s.split()) for s in solutions) / count))
+    print("checked all {} solutions in {:.2f}ms, all solved: {}".format(count, checking * 1000, solved.all()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the facelet cube model')
+    parser.add_argument('-n', '--count', help='States in the batch benchmarks', type=int, default=1000000)
+    parser.add_argument('-l', '--length', help='Scramble length', type=int, default=25)
+    parser.add_argument('-r', '--repeat', help='Repeats of the single solution check', type=int, default=10000)
+    parser.add_argument('-s', '--solve', help='Random states to solve and compile', type=int, default=0)
+    args = parser.parse_args()
+
+    cube = 'DRLUUBFBRBLURRLRUBLRDDFDLFUFUFFDBRDUBRUFLLFDDBFLUBLRBD'
+    solution = "D2 R' D' B F2 D R2 D2 R' F2 D' F2 U' B2 L2 U2 D R2 U"
+    bench_check(cube, solution, args.repeat)
+    bench_batch(args.count, args.length)
+    if args.solve:
+        bench_solve(args.solve)
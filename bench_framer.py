@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# microbenchmark for the serial framing in spike_rpc.RPC
+# pushes a few MB of hub traffic through the old slicing/concatenating reader and the FrameDecoder
+
+import argparse, json, random, time
+from spike_rpc import FrameDecoder, parse_frame
+
+
+class ReplaySerial:
+    # stands in for serial.Serial and hands out a capture in bursts like a backed up OS buffer
+    def __init__(self, data, burst):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.burst = burst
+        self.timeout = None
+
+    @property
+    def in_waiting(self):
+        return min(self.burst, len(self.data) - self.pos)
+
+    def read(self, n = 1):
+        chunk = bytes(self.data[self.pos:self.pos + n])
+        self.pos += len(chunk)
+        return chunk
+
+
+class OldReader:
+    # the reader RPC.getNextMessage used before FrameDecoder
+    def __init__(self, ser):
+        self.ser = ser
+        self.recv_buf = bytearray()
+
+    def getNextMessage(self, timeout = 1):
+        start_time = time.time()
+        elapsed = 0
+        while True:
+            pos = self.recv_buf.find(b'\x0d')
+            if pos >= 0:
+                result = self.recv_buf[:pos]
+                self.recv_buf = self.recv_buf[pos+1:]
+                try:
+                    result = result.decode('utf-8')
+                    return json.loads(result)
+                except json.JSONDecodeError:
+                    return result
+            c = self.ser.in_waiting
+            if c == 0 and elapsed >= timeout:
+                break
+            self.ser.timeout = 1 - timeout
+            self.recv_buf = self.recv_buf + self.ser.read(c if c else 1)
+            elapsed = time.time() - start_time
+        return None
+
+
+def synthetic_traffic(size):
+    # status, battery and print output in roughly the mix the hub sends while a program runs
+    rnd = random.Random(1)
+    frames = []
+    total = 0
+    while total < size:
+        kind = rnd.random()
+        if kind < 0.8:
+            ports = [[75, [0, rnd.randint(-180, 180), rnd.randint(-180, 180), 0]],
+                     [61, [-1, -1, rnd.randint(0, 1024), rnd.randint(0, 1024), rnd.randint(0, 1024)]],
+                     [0, []], [0, []], [0, []], [0, []],
+                     [0.0, 0.0, 0.0], [0, 0, 0], [0, 0, 0], "", 0]
+            frame = json.dumps({'m': 0, 'p': ports})
+        elif kind < 0.85:
+            frame = json.dumps({'m': 2, 'p': [8.294, 100, True]})
+        else:
+            frame = "F-{} color is {}".format(rnd.randint(1, 9), rnd.choice(['white', 'red', 'green']))
+        frame = frame.encode('utf-8') + b'\x0d'
+        frames.append(frame)
+        total += len(frame)
+    return b''.join(frames)
+
+
+def run(reader):
+    count = 0
+    start = time.perf_counter()
+    while reader.getNextMessage(timeout=0) is not None:
+        count += 1
+    return count, time.perf_counter() - start
+
+
+class NewReader:
+    # the RPC reader thread loop, run inline
+    def __init__(self, ser):
+        self.ser = ser
+        self.decoder = FrameDecoder()
+
+    def getNextMessage(self, timeout = 1):
+        while True:
+            frame = self.decoder.next_frame()
+            if frame is not None:
+                return parse_frame(frame)
+            c = self.ser.in_waiting
+            if c == 0:
+                return None
+            self.decoder.feed(self.ser.read(c))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the old and new serial framing on recorded hub traffic')
+    parser.add_argument('-c', '--capture', help='Raw capture of the hub serial output (default: synthetic traffic)')
+    parser.add_argument('-s', '--size', help='Synthetic traffic size in MB', type=float, default=4)
+    parser.add_argument('-b', '--burst', help='Bytes available per serial read', type=int, nargs='+', default=[1024, 16384, 65536, 1048576])
+    args = parser.parse_args()
+
+    if args.capture:
+        with open(args.capture, 'rb') as f:
+            data = f.read()
+    else:
+        data = synthetic_traffic(int(args.size * 1024 * 1024))
+
+    # the hub sends about 11KB a second at 115200 baud, so a read rarely holds more than a few KB
+    for burst in args.burst:
+        print("{:.2f} MB of traffic, {} byte bursts".format(len(data) / 1024 / 1024, burst))
+        for name, factory in (('old', OldReader), ('FrameDecoder', NewReader)):
+            count, elapsed = run(factory(ReplaySerial(data, burst)))
+            print("{:>12}: {} messages in {:.3f}s ({:.1f} MB/s)".format(name, count, elapsed, len(data) / 1024 / 1024 / elapsed))
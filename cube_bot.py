@@ -3,7 +3,7 @@ from spike.control import wait_for_seconds
 from protocol.ujsonrpc import json_rpc
 from spike import ColorSensor
 from math import *
-import uos, ustruct
+import ubinascii, uos, ustruct, utime
 
 
 # constants
@@ -39,6 +39,13 @@ class Face():
 # calibration data
 colorReference = [None] * 6
 calibrationFile = "/data/cubecolors"
+# getSide for every reading, channels quantized to 8 buckets of 128 and indexed as 3 bits each. a
+# bucket that straddles two colors gets the one nearest its middle, the host classifies the raw
+# readings of the whole cube again anyway
+lookupFile = calibrationFile + ".lut"
+lookupShift = 7
+lookupBuckets = 8
+colorLookup = None
 
 # load color reference
 colorReference = [None] * 6
@@ -50,7 +57,7 @@ try:
             colorReference[face] = ustruct.unpack('4I', file.read(16))
             file.close
 except:
-    print("No calibration data.  please calibrate the cube.")
+    print("No calibration data, the tiles are classified by clustering the scan (or calibrate the cube)")
 
 scaner = ColorSensor('E')
 #color values go here 
@@ -134,6 +141,7 @@ def calibrate():
         for rgb in colorReference:
             file.write(ustruct.pack('4I',*rgb))
     file.close
+    saveColorLookup()
     
 def calibrateCenter(face):
     # scaning the centers to compair the color to other peices 
@@ -144,7 +152,60 @@ def calibrateCenter(face):
     print('{} center {}R {}G {}B {}I'.format(face,rgb[0],rgb[1],rgb[2],rgb[3]))
 
 
+def buildColorLookup():
+    # the nearest calibration color for the middle of every bucket of channel values. the squared
+    # distance adds up over the channels, so the per channel terms are computed once and summed
+    half = 1 << (lookupShift - 1)
+    channels = [[[((bucket << lookupShift) + half - ref[k]) ** 2 for ref in colorReference] for bucket in range(lookupBuckets)] for k in range(4)]
+    table = bytearray(lookupBuckets ** 4)
+    index = 0
+    for r in channels[0]:
+        for g in channels[1]:
+            rg = [r[side] + g[side] for side in range(6)]
+            for b in channels[2]:
+                rgb = [rg[side] + b[side] for side in range(6)]
+                for i in channels[3]:
+                    bestSide = 0
+                    bestSideE = rgb[0] + i[0]
+                    for side in range(1, 6):
+                        e = rgb[side] + i[side]
+                        if e < bestSideE:
+                            bestSide = side
+                            bestSideE = e
+                    table[index] = bestSide
+                    index += 1
+    return table
+
+def saveColorLookup():
+    global colorLookup
+    print("Building color lookup table")
+    colorLookup = buildColorLookup()
+    with open(lookupFile, 'wb') as file:
+        file.write(colorLookup)
+
+def loadColorLookup():
+    # the table is built when the colors are calibrated, or here for an older calibration file
+    global colorLookup
+    if None in colorReference:
+        return
+    try:
+        # a table of another size was built with other buckets, one with sides past B left some
+        # buckets to colorDistance
+        if uos.stat(lookupFile)[6] == lookupBuckets ** 4:
+            with open(lookupFile, 'rb') as file:
+                table = bytearray(lookupBuckets ** 4)
+                if file.readinto(table) == len(table) and max(table) < 6:
+                    colorLookup = table
+    except:
+        pass
+    if colorLookup is None:
+        saveColorLookup()
+
 def getSide(rgb):
+    if colorLookup:
+        # one index and no floats, readings go up to 1024 so the top bucket takes that too
+        r, g, b, i = rgb
+        return colorLookup[min(r >> lookupShift, 7) << 9 | min(g >> lookupShift, 7) << 6 | min(b >> lookupShift, 7) << 3 | min(i >> lookupShift, 7)]
     bestSide = -1
     bestSideE = 100000000000
     # loop all the calibrarion colors and return the index of the closest one
@@ -186,6 +247,7 @@ def getSide(rgb):
 
 
 scanResult = [None] * (6 * 9)
+scanRgbi = [None] * (6 * 9)
 scanColorResult = [[None]*9] * 6
 
 def scanCube():
@@ -207,17 +269,21 @@ def scanCube():
     flipX(2)
     rotateY(2)
     scanFace(Face.L)
-    # puttting the cube back in the right orentation 
-    rotateY(2)
-    flipX(1)
-    rotateY(1, prime)
     cubeString = ''.join(scanResult)
     print("cubestring = %s" % cubeString)
     for i in range(6):
         print("{} = {}".format(faceTable[i], ' '.join(scanColorResult[i])))
 
-    # send the cube state to the raspberry pi to be solved
-    json_rpc.emit("cube_scanned", cubeString)
+    # send the cube state to the raspberry pi to be solved straight after the last tile, compiled
+    # plans start from here so the cube is only put back home for face move solutions. the raw
+    # readings go along so the host can classify the tiles together (cube_colors.py)
+    json_rpc.emit("cube_scanned", {'cube': cubeString, 'rgbi': scanRgbi, 'ref': colorReference})
+
+def restoreOrientation():
+    # puttting the cube back in the right orentation, face move solutions start from there
+    rotateY(2)
+    flipX(1)
+    rotateY(1, prime)
 
 def scanFace(face):
     # center
@@ -238,6 +304,13 @@ def scanFace(face):
 def scanTile(face, tile):
     # stating the location and color
     rgb = scaner.get_rgb_intensity()
+    scanRgbi[(face*9) + tile - 1] = rgb
+    if None in colorReference:
+        # without calibration the colours are only known once all the tiles are read (cluster in cube_colors.py)
+        scanResult[(face*9) + tile - 1] = '?'
+        scanColorResult[face][tile - 1] = '?'
+        print("{}-{} reading is {}".format(faceTable[face], tile, rgb))
+        return
     color = getSide(rgb)
     scanResult[(face*9) + tile - 1] = faceTable[color]
     scanColorResult[face][tile - 1] = colorTable[color] # for debugging
@@ -284,12 +357,22 @@ def dMove(count, direction = regular):
 state = dict()
 def recieveSolutionMsg(solution, id):
   print("Recieved solution to cube %s" % solution)
-  # store the solution in a state dictionary that we are waiting for
-  state['solution'] = solution
+  # store the solution in a state dictionary that we are waiting for, streamed plans arrive in
+  # chunks stored under their sequence number
+  if isinstance(solution, dict) and 'seq' in solution:
+      state[solution['seq']] = solution
+  else:
+      state['solution'] = solution
 
 # register the custom message handler for solve_cube
 json_rpc.add_method("solve_cube", recieveSolutionMsg)
 
+def recieveRescanMsg(steps, id):
+  # the host wants some tiles read again before it solves the cube
+  state['rescan'] = steps
+
+json_rpc.add_method("rescan_tiles", recieveRescanMsg)
+
 
 def solveCube(solution: str):
     print("solving cube with moves: %s" % solution)
@@ -308,6 +391,76 @@ def solveCube(solution: str):
         globals()["{}Move".format(face.lower())](count, direction)
 
 
+# [flipper position, [[primitive byte, milliseconds], ...]] of every plan run, sent to the host at
+# the end so robot_timing.py can fit its model to how long the primitives really take
+primitiveTimes = []
+
+def runPlan(plan):
+    # runs a compiled plan, one byte per primitive: op * 4 + quarter turns with op 0 flip, 1 rotate
+    # and 2 bottom turn (see encode_plan in move_compiler.py)
+    print("running plan of %d primitives" % len(plan))
+    flip, rotate, turn = flipX, rotateY, turnD
+    times = []
+    primitiveTimes.append([flipperMotor.get_position(), times])
+    for code in plan:
+        start = utime.ticks_ms()
+        op = code >> 2
+        turns = code & 3
+        if op == 0:
+            flip(turns)
+        elif turns == 3:
+            if op == 1:
+                rotate(1, prime)
+            else:
+                turn(1, prime)
+        elif op == 1:
+            rotate(turns)
+        else:
+            turn(turns)
+        times.append([code, utime.ticks_diff(utime.ticks_ms(), start)])
+
+
+def rescanTiles(steps):
+    # steps from rescan_planner.py: primitive byte codes for runPlan, '+' and '-' to turn the cube 45
+    # degrees like scanFace and [tile, flipper position] to read a tile
+    scanPositions = {'scan_edge': flipperScanEdge, 'scan_corner': flipperScanCorner, 'scan_center': flipperScanCenter}
+    readings = []
+    for step in steps:
+        if isinstance(step, list):
+            flipperMotor.run_to_position(scanPositions[step[1]])
+            readings.append([step[0], scaner.get_rgb_intensity()])
+        elif step == '+':
+            rotaterMotor.run_for_degrees(45)
+        elif step == '-':
+            rotaterMotor.run_for_degrees(-45)
+        else:
+            runPlan(bytes([step]))
+    json_rpc.emit("tiles_rescanned", readings)
+
+
+# milliseconds to wait for the next chunk of a streamed plan, the host sends it within its solve timeout
+streamTimeout = 60000
+
+def runStreamedPlan():
+    # runs plan chunks in order as they arrive, the host keeps improving the later ones meanwhile.
+    # when a chunk does not come the plan is given up and the cube let go instead of held mid solve
+    seq = 0
+    while True:
+        start = utime.ticks_ms()
+        while seq not in state:
+            if utime.ticks_diff(utime.ticks_ms(), start) > streamTimeout:
+                print("No chunk %d of the plan within %ds, giving up" % (seq, streamTimeout // 1000))
+                json_rpc.emit("plan_aborted", seq)
+                flipperMotor.run_to_position(flipperHome, "counterclockwise")
+                return
+            wait_for_seconds(.05)
+        chunk = state.pop(seq)
+        runPlan(ubinascii.a2b_base64(chunk['plan']))
+        if chunk.get('last'):
+            break
+        seq += 1
+
+
 # compute distance between two colors.  see https://stackoverflow.com/questions/54242194/python-find-the-closest-color-to-a-color-from-giving-list-of-colors
 def colorDistance(rgbi1, rgb2):
     r, g, b, i = rgbi1
@@ -316,61 +469,8 @@ def colorDistance(rgbi1, rgb2):
     return sqrt((r - cr)**2 + (g - cg)**2 + (b - cb)**2 + (i - ib)**2)
 
 
-# in case we need super fancy math
-# convert rgb to CIELAB color space. see https://en.wikipedia.org/wiki/CIELAB_color_space
-def rgb2lab ( inputColor ) :
-
-   num = 0
-   RGB = [0, 0, 0]
-
-   for value in inputColor :
-       value = float(value) / 255
-
-       if value > 0.04045 :
-           value = ( ( value + 0.055 ) / 1.055 ) ** 2.4
-       else :
-           value = value / 12.92
-
-       RGB[num] = value * 100
-       num = num + 1
-
-   XYZ = [0, 0, 0,]
-
-   X = RGB [0] * 0.4124 + RGB [1] * 0.3576 + RGB [2] * 0.1805
-   Y = RGB [0] * 0.2126 + RGB [1] * 0.7152 + RGB [2] * 0.0722
-   Z = RGB [0] * 0.0193 + RGB [1] * 0.1192 + RGB [2] * 0.9505
-   XYZ[ 0 ] = round( X, 4 )
-   XYZ[ 1 ] = round( Y, 4 )
-   XYZ[ 2 ] = round( Z, 4 )
-
-   XYZ[ 0 ] = float( XYZ[ 0 ] ) / 95.047         # ref_X =  95.047   Observer= 2°, Illuminant= D65
-   XYZ[ 1 ] = float( XYZ[ 1 ] ) / 100.0          # ref_Y = 100.000
-   XYZ[ 2 ] = float( XYZ[ 2 ] ) / 108.883        # ref_Z = 108.883
-
-   num = 0
-   for value in XYZ :
-
-       if value > 0.008856 :
-           value = value ** ( 0.3333333333333333 )
-       else :
-           value = ( 7.787 * value ) + ( 16 / 116 )
-
-       XYZ[num] = value
-       num = num + 1
-
-   Lab = [0, 0, 0]
-
-   L = ( 116 * XYZ[ 1 ] ) - 16
-   a = 500 * ( XYZ[ 0 ] - XYZ[ 1 ] )
-   b = 200 * ( XYZ[ 1 ] - XYZ[ 2 ] )
-
-   Lab [ 0 ] = round( L, 4 )
-   Lab [ 1 ] = round( a, 4 )
-   Lab [ 2 ] = round( b, 4 )
-
-   return Lab
-
 # main program
+loadColorLookup()
 Initialize()
 
 # wait for scramble and input
@@ -381,14 +481,27 @@ Initialize()
 scanCube()
 
 print("Waiting for solution")
-while('solution' not in state):
+while('solution' not in state and 0 not in state):
+    if 'rescan' in state:
+        rescanTiles(state.pop('rescan'))
     wait_for_seconds(.1)
 
-# # get the solution and delete it
-solution = state['solution']
-del state['solution']
-
-solveCube(solution)
+if 0 in state:
+    # start on the first chunk of a streamed plan straight away
+    runStreamedPlan()
+else:
+    # # get the solution and delete it
+    solution = state['solution']
+    del state['solution']
+
+    if isinstance(solution, dict):
+        # a compiled plan starts from where the scan left the cube
+        runPlan(ubinascii.a2b_base64(solution['plan']))
+    else:
+        restoreOrientation()
+        solveCube(solution)
+# robot_timing.py fits its model to these
+json_rpc.emit("primitives_timed", primitiveTimes)
 
 
 
@@ -1,5 +1,9 @@
 from buildhat import Motor, ColorSensor, ForceSensor
-import kociemba  # for custom event to solve cubes
+from cube_colors import RESCAN_LIMIT, classify, cluster, doubtful_tiles, tile_name
+from cube_solver import CachedSolver  # for custom event to solve cubes
+from move_compiler import ORIENTATIONS, SCANNED, apply_plan, compile_solution, encode_plan
+from rescan_planner import format_steps, plan_rescan
+from robot_timing import PI_TIMES_FILE, SOLVE_START, record_times
 from math import *
 import os, struct, time
 
@@ -49,7 +53,7 @@ try:
             colorReference[face] = struct.unpack('4I', file.read(16))
             file.close
 except:
-    print("No calibration data.  please calibrate the cube.")
+    print("No calibration data, the tiles are classified by clustering the scan (or calibrate the cube)")
 
 scaner = ColorSensor('A')
 #color values go here 
@@ -183,7 +187,14 @@ def getSide(rgb):
 
 
 scanResult = [None] * (6 * 9)
+scanRgbi = [None] * (6 * 9)
 scanColorResult = [[None]*9] * 6
+# scanCube's flips and rotations, on the hub they leave the cube in SCANNED. scanFace here turns the
+# rotater to absolute positions, which undoes the rotateY calls made right before a face, so on the
+# pi only PI_SCAN is left of them and the cube ends in PI_SCANNED
+HUB_SCAN = ['X', 'X', 'X', 'X', 'Y2', "Y'", 'X', 'Y', 'X2', 'Y2']
+PI_SCAN = ['X', 'X', 'X', 'X', "Y'", 'X', 'Y', 'X2']
+PI_SCANNED = apply_plan(next(o for o in ORIENTATIONS if apply_plan(o, HUB_SCAN) == SCANNED), PI_SCAN)
 
 def scanCube():
     # scaning the whole cube
@@ -204,17 +215,46 @@ def scanCube():
     flipX(2)
     rotateY(2)
     scanFace(Face.L)
-    # puttting the cube back in the right orentation 
-    rotateY(2)
-    flipX(1)
-    rotateY(1, prime)
+    # the cube is left where the scan ended, compiled plans start from there (PI_SCANNED)
     cubeString = ''.join(scanResult)
     print("cubestring = %s" % cubeString)
     for i in range(6):
         print("{} = {}".format(faceTable[i], ' '.join(scanColorResult[i])))
 
+    # classify all the tiles together so a misread tile is fixed instead of making the cube unsolvable
+    if None in colorReference:
+        cubeString, confidence, references = cluster(scanRgbi)
+    else:
+        cubeString, confidence = classify(scanRgbi, colorReference)
+    if cubeString != ''.join(scanResult):
+        print("corrected cubestring = %s" % cubeString)
+    print("least certain tiles: %s" % ' '.join("{}:{:.2f}".format(tile_name(i), confidence[i]) for i in sorted(range(54), key=confidence.__getitem__)[:3]))
+
     # send the cube state to the raspberry pi to be solved
-    return cubeString
+    return cubeString, confidence
+
+def rescanTiles(tiles):
+    # reads tiles again instead of scanning the whole cube, returns the cube string, the orientation
+    # the cube is left in and the flipper position
+    seconds, steps, orientation, position = plan_rescan(tiles, PI_SCANNED)
+    print("rescanning {} (est. {:.0f}s)".format(format_steps(steps), seconds))
+    scanPositions = {'scan_edge': flipperScanEdge, 'scan_corner': flipperScanCorner, 'scan_center': flipperScanCenter}
+    for step in steps:
+        if isinstance(step, list):
+            flipperMotor.run_to_position(scanPositions[step[1]])
+            scanRgbi[step[0]] = scaner.get_color_rgbi()
+        elif step == '+':
+            rotaterMotor.run_for_degrees(45)
+        elif step == '-':
+            rotaterMotor.run_for_degrees(-45)
+        else:
+            runPlan(encode_plan([step]))
+    if None in colorReference:
+        cubeString, confidence, references = cluster(scanRgbi)
+    else:
+        cubeString, confidence = classify(scanRgbi, colorReference)
+    print("rescanned cubestring = %s" % cubeString)
+    return cubeString, orientation, position
 
 def scanFace(face):
     # center
@@ -240,6 +280,13 @@ def scanFace(face):
 def scanTile(face, tile):
     # stating the location and color
     rgb = scaner.get_color_rgbi()
+    scanRgbi[(face*9) + tile - 1] = rgb
+    if None in colorReference:
+        # without calibration the colours are only known once all the tiles are read (cluster in cube_colors.py)
+        scanResult[(face*9) + tile - 1] = '?'
+        scanColorResult[face][tile - 1] = '?'
+        print("{}-{} reading is {}".format(faceTable[face], tile, rgb))
+        return
     color = getSide(rgb)
     scanResult[(face*9) + tile - 1] = faceTable[color]
     scanColorResult[face][tile - 1] = colorTable[color] # for debugging
@@ -301,6 +348,34 @@ def solveCube(solution: str):
         globals()["{}Move".format(face.lower())](count, direction)
 
 
+# [flipper position, [[primitive byte, milliseconds], ...]] of every plan run, for python3 robot_timing.py --fit
+primitiveTimes = []
+
+def runPlan(plan):
+    # runs a compiled plan, one byte per primitive: op * 4 + quarter turns with op 0 flip, 1 rotate
+    # and 2 bottom turn (see encode_plan in move_compiler.py)
+    print("running plan of %d primitives" % len(plan))
+    flip, rotate, turn = flipX, rotateY, turnD
+    times = []
+    primitiveTimes.append([flipperMotor.get_position(), times])
+    for code in plan:
+        start = time.monotonic()
+        op = code >> 2
+        turns = code & 3
+        if op == 0:
+            flip(turns)
+        elif turns == 3:
+            if op == 1:
+                rotate(1, prime)
+            else:
+                turn(1, prime)
+        elif op == 1:
+            rotate(turns)
+        else:
+            turn(turns)
+        times.append([code, round((time.monotonic() - start) * 1000)])
+
+
 # compute distance between two colors.  see https://stackoverflow.com/questions/54242194/python-find-the-closest-color-to-a-color-from-giving-list-of-colors
 def colorDistance(rgbi1, rgb2):
     r, g, b, i = rgbi1
@@ -309,61 +384,10 @@ def colorDistance(rgbi1, rgb2):
     return sqrt((r - cr)**2 + (g - cg)**2 + (b - cb)**2 + (i - ib)**2)
 
 
-# in case we need super fancy math
-# convert rgb to CIELAB color space. see https://en.wikipedia.org/wiki/CIELAB_color_space
-def rgb2lab ( inputColor ) :
-
-   num = 0
-   RGB = [0, 0, 0]
-
-   for value in inputColor :
-       value = float(value) / 255
-
-       if value > 0.04045 :
-           value = ( ( value + 0.055 ) / 1.055 ) ** 2.4
-       else :
-           value = value / 12.92
-
-       RGB[num] = value * 100
-       num = num + 1
-
-   XYZ = [0, 0, 0,]
-
-   X = RGB [0] * 0.4124 + RGB [1] * 0.3576 + RGB [2] * 0.1805
-   Y = RGB [0] * 0.2126 + RGB [1] * 0.7152 + RGB [2] * 0.0722
-   Z = RGB [0] * 0.0193 + RGB [1] * 0.1192 + RGB [2] * 0.9505
-   XYZ[ 0 ] = round( X, 4 )
-   XYZ[ 1 ] = round( Y, 4 )
-   XYZ[ 2 ] = round( Z, 4 )
-
-   XYZ[ 0 ] = float( XYZ[ 0 ] ) / 95.047         # ref_X =  95.047   Observer= 2°, Illuminant= D65
-   XYZ[ 1 ] = float( XYZ[ 1 ] ) / 100.0          # ref_Y = 100.000
-   XYZ[ 2 ] = float( XYZ[ 2 ] ) / 108.883        # ref_Z = 108.883
-
-   num = 0
-   for value in XYZ :
-
-       if value > 0.008856 :
-           value = value ** ( 0.3333333333333333 )
-       else :
-           value = ( 7.787 * value ) + ( 16 / 116 )
-
-       XYZ[num] = value
-       num = num + 1
-
-   Lab = [0, 0, 0]
-
-   L = ( 116 * XYZ[ 1 ] ) - 16
-   a = 500 * ( XYZ[ 0 ] - XYZ[ 1 ] )
-   b = 200 * ( XYZ[ 1 ] - XYZ[ 2 ] )
-
-   Lab [ 0 ] = round( L, 4 )
-   Lab [ 1 ] = round( a, 4 )
-   Lab [ 2 ] = round( b, 4 )
-
-   return Lab
-
 # main program
+# load the solver tables in the background while the robot initializes and scans
+solver = CachedSolver()
+solver.warm_up()
 Initialize()
 
 # wait for scramble and input
@@ -371,9 +395,15 @@ Initialize()
 
 # tests
 # calibrate()
-cube = scanCube()
-solution = kociemba.solve(cube)
-solveCube(solution)
+cube, confidence = scanCube()
+orientation, position = PI_SCANNED, SOLVE_START
+doubtful = doubtful_tiles(confidence)
+if doubtful and len(doubtful) <= RESCAN_LIMIT:
+    cube, orientation, position = rescanTiles(doubtful)
+solution = solver.solve(cube, budget=1, orientation=orientation, position=position)
+# turn the face moves into flips, rotations and bottom turns without returning home after every move
+runPlan(encode_plan(compile_solution(solution, orientation)))
+record_times(primitiveTimes, PI_TIMES_FILE)
 
 
 
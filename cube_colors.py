@@ -0,0 +1,211 @@
+# classifies the 54 scanned RGBI readings of a cube as a whole
+#
+# getSide on the hub picks the nearest calibrated colour for every tile on its own, so one tile
+# read under glare gives a cube kociemba rejects. here the tiles are classified together: each
+# corner and edge position is given a whole cubie (with its twist or flip) by min cost assignment,
+# so every colour appears on exactly 9 tiles and every corner and edge has a colour combination the
+# cube really has. the twist, flip and permutation parities are then fixed by the cheapest change,
+# so the result can always be solved.
+#
+# without calibrated references the colours are found by clustering the readings themselves, see cluster.
+#
+# the cost of reading a tile as a colour is the squared distance to the colour's reference, which is
+# its negative log likelihood under gaussian sensor noise. the confidence of a tile is the posterior
+# probability of the colour it got against the other five.
+
+import math
+from cube_model import CORNER_COLOURS, CORNER_FACELETS, EDGE_COLOURS, EDGE_FACELETS
+from cube_symmetry import FACES
+
+
+# tiles classified with less confidence than this are reported, and read again when there are at
+# most RESCAN_LIMIT of them
+LOW_CONFIDENCE = 0.9
+RESCAN_LIMIT = 6
+
+# median of a chi squared distribution with 3 and 4 degrees of freedom
+CHI2_MEDIAN = {3: 2.366, 4: 3.357}
+
+# sensor channels go up to 1024
+SENSOR_MAX = 1024
+
+
+def distance2(rgbi, reference):
+    return sum((a - b) ** 2 for a, b in zip(rgbi, reference))
+
+
+def rgbi_to_lab(rgbi):
+    # CIELAB (D65) of a reading, the intensity channel is left out
+    linear = []
+    for value in rgbi[:3]:
+        value = min(value, SENSOR_MAX) / SENSOR_MAX
+        linear.append(((value + 0.055) / 1.055) ** 2.4 if value > 0.04045 else value / 12.92)
+    r, g, b = linear
+    xyz = ((r * 0.4124 + g * 0.3576 + b * 0.1805) / 0.95047, r * 0.2126 + g * 0.7152 + b * 0.0722, (r * 0.0193 + g * 0.1192 + b * 0.9505) / 1.08883)
+    fx, fy, fz = (t ** (1 / 3) if t > 0.008856 else 7.787 * t + 16 / 116 for t in xyz)
+    return (116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz))
+
+
+def assign(cost):
+    # min cost perfect matching of a square cost matrix, row i gets column assignment[i]
+    # (the O(n^3) Hungarian algorithm with row and column potentials)
+    n = len(cost)
+    u, v = [0] * (n + 1), [0] * (n + 1)
+    match, way = [0] * (n + 1), [0] * (n + 1)
+    for i in range(1, n + 1):
+        match[0] = i
+        column = 0
+        slack = [math.inf] * (n + 1)
+        used = [False] * (n + 1)
+        while match[column]:
+            used[column] = True
+            row, delta, nearest = match[column], math.inf, 0
+            for j in range(1, n + 1):
+                if not used[j]:
+                    reduced = cost[row - 1][j - 1] - u[row] - v[j]
+                    if reduced < slack[j]:
+                        slack[j], way[j] = reduced, column
+                    if slack[j] < delta:
+                        delta, nearest = slack[j], j
+            for j in range(n + 1):
+                if used[j]:
+                    u[match[j]] += delta
+                    v[j] -= delta
+                else:
+                    slack[j] -= delta
+            column = nearest
+        while column:
+            previous = way[column]
+            match[column] = match[previous]
+            column = previous
+    assignment = [0] * n
+    for j in range(1, n + 1):
+        assignment[match[j] - 1] = j - 1
+    return assignment
+
+
+def _costs(tile_costs, positions, pieces):
+    # costs[position][piece][orientation], orientation k puts the piece's first colour on facelet k
+    costs = []
+    for facelets in positions:
+        row = []
+        for colours in pieces:
+            colours = [FACES.index(c) for c in colours]
+            size = len(colours)
+            row.append([sum(tile_costs[facelets[(k + i) % size]][colours[i]] for i in range(size)) for k in range(size)])
+        costs.append(row)
+    return costs
+
+
+def _best(options):
+    return min(range(len(options)), key=options.__getitem__)
+
+
+def _parity(permutation):
+    return sum(a > b for i, a in enumerate(permutation) for b in permutation[i + 1:]) % 2
+
+
+def _cheapest_swap(costs, permutation, orientation):
+    # (extra cost, i, j) of the cheapest exchange of two pieces
+    best = (math.inf, None, None)
+    for i in range(len(permutation)):
+        for j in range(i + 1, len(permutation)):
+            now = costs[i][permutation[i]][orientation[i]] + costs[j][permutation[j]][orientation[j]]
+            swapped = min(costs[i][permutation[j]]) + min(costs[j][permutation[i]])
+            best = min(best, (swapped - now, i, j))
+    return best
+
+
+def _fix_orientation(costs, permutation, orientation, size):
+    # turn the one piece that makes the orientations add up for the least extra cost
+    excess = sum(orientation) % size
+    if excess:
+        i = min(range(len(orientation)), key=lambda i: costs[i][permutation[i]][(orientation[i] - excess) % size])
+        orientation[i] = (orientation[i] - excess) % size
+
+
+def classify(readings, references = None, space = None):
+    """
+    Returns (cube string, confidence) for the 54 RGBI readings in facelet order. references are
+    the calibrated RGBI of the U R F D L B colours, the center readings when None. confidence[i]
+    is the probability that tile i has the colour it was given. space converts readings and
+    references before they are compared, e.g. rgbi_to_lab.
+    """
+    if references is None:
+        references = [readings[face * 9 + 4] for face in range(6)]
+    if space is not None:
+        readings, references = [space(r) for r in readings], [space(r) for r in references]
+    tile_costs = [[distance2(rgbi, reference) for reference in references] for rgbi in readings]
+    corners = _costs(tile_costs, CORNER_FACELETS, CORNER_COLOURS)
+    edges = _costs(tile_costs, EDGE_FACELETS, EDGE_COLOURS)
+    cp = assign([[min(options) for options in row] for row in corners])
+    ep = assign([[min(options) for options in row] for row in edges])
+    co = [_best(corners[i][cp[i]]) for i in range(8)]
+    eo = [_best(edges[i][ep[i]]) for i in range(12)]
+
+    # a cube with odd corner and even edge permutation (or the other way round) cannot be solved
+    if _parity(cp) != _parity(ep):
+        corner_swap, edge_swap = _cheapest_swap(corners, cp, co), _cheapest_swap(edges, ep, eo)
+        costs, permutation, orientation, (_, i, j) = min(
+            (corners, cp, co, corner_swap), (edges, ep, eo, edge_swap), key=lambda option: option[3][0])
+        permutation[i], permutation[j] = permutation[j], permutation[i]
+        orientation[i], orientation[j] = _best(costs[i][permutation[i]]), _best(costs[j][permutation[j]])
+    _fix_orientation(corners, cp, co, 3)
+    _fix_orientation(edges, ep, eo, 2)
+
+    colours = [i // 9 if i % 9 == 4 else None for i in range(54)]
+    for positions, pieces, permutation, orientation in (
+            (CORNER_FACELETS, CORNER_COLOURS, cp, co), (EDGE_FACELETS, EDGE_COLOURS, ep, eo)):
+        for facelets, piece, k in zip(positions, permutation, orientation):
+            for i, colour in enumerate(pieces[piece]):
+                colours[facelets[(k + i) % len(facelets)]] = FACES.index(colour)
+
+    return ''.join(FACES[c] for c in colours), _confidence(tile_costs, colours, len(readings[0]))
+
+
+def _confidence(tile_costs, colours, dimensions, own = 1):
+    # posterior of each tile's colour, own scales the cost of the colour the tile got
+    tile_costs = [[cost * own if c == colour else cost for c, cost in enumerate(costs)] for costs, colour in zip(tile_costs, colours)]
+    # the noise variance per channel from how far the tiles are from the colours they got: the squared
+    # distance over 4 channels has a median of about 3.36 variances (2.37 over 3), and the median ignores glare
+    distances = sorted(tile_costs[i][c] for i, c in enumerate(colours) if i % 9 != 4)
+    variance = max(distances[len(distances) // 2] / CHI2_MEDIAN[dimensions], 1)
+    confidence = []
+    for costs, colour in zip(tile_costs, colours):
+        lowest = min(costs)
+        weights = [math.exp((lowest - cost) / (2 * variance)) for cost in costs]
+        confidence.append(weights[colour] / sum(weights))
+    return confidence
+
+
+def cluster(readings, iterations = 10, space = None):
+    """
+    Calibration free classify: k-means of the readings into six clusters of 9 anchored on the centers.
+    The means start at the center readings, each round classifies the tiles against them with the
+    same constraints as classify and moves them to the tiles each colour got. Returns
+    (cube string, confidence, references) with the final means as references, in space if given.
+    """
+    if space is not None:
+        readings = [space(r) for r in readings]
+    references = [readings[face * 9 + 4] for face in range(6)]
+    cube = None
+    for _ in range(iterations):
+        classified, _ = classify(readings, references)
+        if classified == cube:
+            break
+        cube = classified
+        references = [[sum(channel) / 9 for channel in zip(*[readings[i] for i in range(54) if cube[i] == face])] for face in FACES]
+    # every mean includes the tile itself, which makes the colour a tile got look closer than it is.
+    # against the mean of the other 8 the squared distance is (9 / 8) ** 2 times larger
+    tile_costs = [[distance2(rgbi, reference) for reference in references] for rgbi in readings]
+    return cube, _confidence(tile_costs, [FACES.index(c) for c in cube], len(readings[0]), (9 / 8) ** 2), references
+
+
+def tile_name(index):
+    # 'U1' .. 'B9' as printed by scanTile
+    return '{}{}'.format(FACES[index // 9], index % 9 + 1)
+
+
+def doubtful_tiles(confidence):
+    # the centers define the colours, so they are never in doubt
+    return [i for i in range(54) if i % 9 != 4 and confidence[i] < LOW_CONFIDENCE]
@@ -0,0 +1,152 @@
+# facelet level cube model for checking solutions and simulating many cubes at once
+#
+# every face move is a permutation of the 54 facelets, source[i] being the facelet that moves to
+# position i, and a whole solution composes into one such permutation. checking a solution is then a
+# single pass over the scanned string, and with numpy the same index arrays turn whole batches of
+# states (one uint8 row per cube) at once.
+#
+# python3 bench_cube_model.py
+
+import functools
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from cube_symmetry import FACE_TURNS, FACES
+
+SOLVED = ''.join(face * 9 for face in FACES)
+
+# the 18 face moves in kociemba's order
+MOVE_NAMES = [face + suffix for face in FACES for suffix in ('', '2', "'")]
+
+# facelet indexes of each corner and edge in the 54 character string, U1 is 0, R1 9, F1 18 ...
+# the cubies and their colours are in kociemba's order
+CORNER_FACELETS = [[8, 9, 20], [6, 18, 38], [0, 36, 47], [2, 45, 11], [29, 26, 15], [27, 44, 24], [33, 53, 42], [35, 17, 51]]
+EDGE_FACELETS = [[5, 10], [7, 19], [3, 37], [1, 46], [32, 16], [28, 25], [30, 43], [34, 52],
+                 [23, 12], [21, 41], [50, 39], [48, 14]]
+CORNER_COLOURS = ['URF', 'UFL', 'ULB', 'UBR', 'DFR', 'DLF', 'DBL', 'DRB']
+EDGE_COLOURS = ['UR', 'UF', 'UL', 'UB', 'DR', 'DF', 'DL', 'DB', 'FR', 'FL', 'BL', 'BR']
+
+
+def compose(first, then):
+    # the permutation of running first and then then
+    return [first[i] for i in then]
+
+
+def _move_permutations():
+    permutations = {}
+    for face in FACES:
+        quarter = FACE_TURNS[face]
+        half = compose(quarter, quarter)
+        permutations[face] = quarter
+        permutations[face + '2'] = half
+        permutations[face + "'"] = compose(half, quarter)
+    return permutations
+
+
+MOVES = _move_permutations()
+IDENTITY = list(range(54))
+
+
+@functools.lru_cache(maxsize=256)
+def solution_permutation(solution):
+    # the permutation of a whole solution string
+    permutation = IDENTITY
+    for move in solution.split():
+        permutation = compose(permutation, MOVES[move])
+    return permutation
+
+
+def apply_moves(cube, moves):
+    # the facelet string after the face moves of a solution string
+    return ''.join([cube[i] for i in solution_permutation(moves)])
+
+
+def is_solved(cube):
+    return all(cube[i] == cube[i - i % 9 + 4] for i in range(54))
+
+
+def check_solution(cube, solution):
+    # raises ValueError unless solution solves cube, a bad plan costs minutes of robot moves
+    if not is_solved(apply_moves(cube, solution)):
+        raise ValueError('solution {} does not solve the cube'.format(solution))
+
+
+# batches of states as uint8 arrays, one row of 54 ascii codes per cube
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError('batch cube states need numpy, install it with pip3 install numpy')
+
+
+# move index that leaves a state alone, pads solutions of different lengths
+PAD = len(MOVE_NAMES)
+
+
+@functools.lru_cache(maxsize=1)
+def move_table():
+    # (19, 54) index array, row m turns a state by MOVE_NAMES[m] and row PAD is the identity
+    _require_numpy()
+    return np.array([MOVES[name] for name in MOVE_NAMES] + [IDENTITY], dtype=np.intp)
+
+
+def encode(cubes):
+    _require_numpy()
+    if isinstance(cubes, str):
+        cubes = [cubes]
+    return np.frombuffer(''.join(cubes).encode('ascii'), dtype=np.uint8).reshape(-1, 54)
+
+
+def decode(states):
+    return [row.tobytes().decode('ascii') for row in np.atleast_2d(states)]
+
+
+def apply_solution(states, solution):
+    # every state turned by the same solution
+    return states[..., solution_permutation(solution)]
+
+
+def apply_each(states, moves):
+    # state n turned by MOVE_NAMES[moves[n]], rows are grouped by move so each group is one fancy index
+    table = move_table()
+    out = np.empty_like(states)
+    order = np.argsort(moves, kind='stable')
+    bounds = np.searchsorted(moves[order], np.arange(len(table) + 1))
+    for m in range(len(table)):
+        rows = order[bounds[m]:bounds[m + 1]]
+        if len(rows):
+            out[rows] = states[rows][:, table[m]]
+    return out
+
+
+def encode_solutions(solutions):
+    # (count, longest) move indexes of solution strings, shorter ones padded with PAD
+    _require_numpy()
+    index = {name: i for i, name in enumerate(MOVE_NAMES)}
+    moves = [[index[move] for move in solution.split()] for solution in solutions]
+    table = np.full((len(moves), max(map(len, moves), default=0)), PAD, dtype=np.intp)
+    for row, m in zip(table, moves):
+        row[:len(m)] = m
+    return table
+
+
+def apply_solutions(states, solutions):
+    # state n turned by solution n, solutions as returned by encode_solutions
+    for moves in solutions.T:
+        states = apply_each(states, moves)
+    return states
+
+
+def solved_mask(states):
+    # True for the rows whose faces all match their centers
+    faces = states.reshape(-1, 6, 9)
+    return (faces == faces[:, :, 4:5]).all(axis=(1, 2))
+
+
+def random_states(count, length = 25, seed = None):
+    # count cubes scrambled by length random face moves each, with the scrambles
+    _require_numpy()
+    rng = np.random.default_rng(seed)
+    states = np.repeat(encode(SOLVED), count, axis=0)
+    scrambles = rng.integers(len(MOVE_NAMES), size=(length, count))
+    return apply_solutions(states, scrambles.T), scrambles.T
@@ -0,0 +1,333 @@
+# cube solving for the host programs (run_spike.py and cube_bot_pi.py)
+
+import asyncio, collections, concurrent.futures, multiprocessing, os, sqlite3, threading, time
+import kociemba
+from cube_model import apply_moves, check_solution, is_solved
+from cube_symmetry import ROTATIONS, SYMMETRIES, canonicalize
+from move_compiler import SCANNED
+from robot_search import robot_solve
+from robot_timing import SOLVE_START, fastest, robot_seconds
+
+# persistent store of solved states
+SOLUTION_DB = os.path.expanduser('~/.cubebot/solutions.sqlite')
+
+# solved once at startup so kociemba loads its pruning tables before the first real scan
+WARM_UP_CUBE = 'DRLUUBFBRBLURRLRUBLRDDFDLFUFUFFDBRDUBRUFLLFDDBFLUBLRBD'
+
+
+def timed_solve(solve, cube):
+    start = time.time()
+    solve(cube)
+    return time.time() - start
+
+
+def report_warm_up(future):
+    if not future.cancelled() and future.exception() is None:
+        print("Solver warm-up took %.2fs" % future.result())
+
+
+def wait_for_warm_up(future):
+    # a failed warm-up only means the first solve loads the tables itself
+    try:
+        future.result()
+    except Exception:
+        pass
+
+
+def fastest_solution(solve, cube, symmetries = ROTATIONS, budget = None, orientation = SCANNED, position = SOLVE_START):
+    """
+    Solves cube turned by each of symmetries, kociemba finds a different solution for each
+    orientation, and returns (estimated robot seconds, solution, candidates) for the one the
+    robot runs quickest starting in orientation with the flipper at position. Stops trying
+    orientations after budget seconds, the identity comes first so there is always at least one
+    candidate.
+    """
+    start = time.time()
+    solutions = []
+    for s in symmetries:
+        if solutions and budget is not None and time.time() - start > budget:
+            break
+        solutions.append(s.inverse.map_solution(solve(s.apply(cube))))
+    seconds, solution = fastest(solutions, orientation=orientation, position=position)
+    return seconds, solution, len(solutions)
+
+
+def solve_rotations(solve, cube, rotations, orientation = SCANNED, position = SOLVE_START):
+    # [(estimated robot seconds, solution, rotation)] for cube solved turned by each ROTATIONS[rotation],
+    # with the robot starting in orientation and the flipper at position
+    results = []
+    for i in rotations:
+        s = ROTATIONS[i]
+        solution = s.inverse.map_solution(solve(s.apply(cube)))
+        results.append((robot_seconds(solution, orientation=orientation, position=position), solution, i))
+    return results
+
+
+def settle(set_value, value):
+    # pool callbacks run in its result thread and must not raise, a future that was cancelled stays cancelled
+    try:
+        set_value(value)
+    except concurrent.futures.InvalidStateError:
+        pass
+
+
+class SolveCancelled(Exception):
+    # a solve stopped by SolverPool.cancel, raised instead of asyncio.CancelledError so the task that
+    # waited for it is not taken for cancelled itself
+    pass
+
+
+def report_fastest(seconds, solution, candidates):
+    print("Picked the fastest of %d candidate solutions (est. %.0fs)" % (candidates, seconds))
+    return solution
+
+
+class SolutionCache:
+    # in memory LRU in front of a sqlite store, keyed by the 54 character facelet string
+    def __init__(self, path = SOLUTION_DB, size = 1024):
+        self.lru = collections.OrderedDict()
+        self.size = size
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS solutions (cube TEXT PRIMARY KEY, solution TEXT NOT NULL)')
+            self.db.commit()
+
+    def _remember(self, cube, solution):
+        self.lru[cube] = solution
+        self.lru.move_to_end(cube)
+        if len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+
+    def get(self, cube):
+        with self.lock:
+            solution = self.lru.get(cube)
+            if solution is not None:
+                self.lru.move_to_end(cube)
+                self.hits += 1
+                return solution
+            if self.db:
+                row = self.db.execute('SELECT solution FROM solutions WHERE cube = ?', (cube,)).fetchone()
+                if row:
+                    self._remember(cube, row[0])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, cube, solution):
+        with self.lock:
+            self._remember(cube, solution)
+            if self.db:
+                self.db.execute('INSERT OR REPLACE INTO solutions (cube, solution) VALUES (?, ?)', (cube, solution))
+                self.db.commit()
+
+    def stats(self):
+        return "solution cache: {} hits ({} from disk), {} misses".format(self.hits, self.disk_hits, self.misses)
+
+
+class CachedSolver:
+    # kociemba.solve with solutions remembered across scans and runs
+    # states are cached under their canonical form so the same scramble seen in another
+    # orientation, mirrored or with other colours is still a hit
+    def __init__(self, cache = None, solve = kociemba.solve, symmetries = SYMMETRIES):
+        self.cache = cache if cache is not None else SolutionCache()
+        self.solve_fn = solve
+        self.symmetries = symmetries
+        self.warming = None
+
+    def warm_up(self):
+        # load the solver tables in a background thread, a solve issued meanwhile waits for it
+        executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.warming = executor.submit(timed_solve, self.solve_fn, WARM_UP_CUBE)
+        self.warming.add_done_callback(report_warm_up)
+        executor.shutdown(wait=False)
+        return self.warming
+
+    def _key(self, cube, orientation = None, position = SOLVE_START):
+        # a solution picked for the robot starting in orientation with the flipper at position is only
+        # the fastest from there, so the start is appended to the key. such keys are canonical over the
+        # rotations only, with the orientation relabeled by the rotation that canonicalizes the cube
+        if orientation is None:
+            return canonicalize(cube, self.symmetries) if self.symmetries else (cube, None)
+        rotations = [s for s in self.symmetries if not s.mirror]
+        if not rotations:
+            return '%s %s %s' % (cube, ''.join(orientation), position), None
+        key, symmetry = canonicalize(cube, rotations)
+        return '%s %s %s' % (key, ''.join(symmetry.faces[face] for face in orientation), position), symmetry
+
+    def lookup(self, cube, orientation = None, position = SOLVE_START):
+        # cached solution for cube or None, a cached solution that does not solve cube counts as a miss
+        # with an orientation only a solution picked for the robot starting there is returned
+        key, symmetry = self._key(cube, orientation, position)
+        solution = self.cache.get(key)
+        if solution is not None and symmetry is not None:
+            solution = symmetry.inverse.map_solution(solution)
+        if solution is not None and not is_solved(apply_moves(cube, solution)):
+            return None
+        return solution
+
+    def remember(self, cube, solution, orientation = None, position = SOLVE_START):
+        # raises ValueError when solution does not solve cube, so it is neither kept nor sent
+        check_solution(cube, solution)
+        key, symmetry = self._key(cube, orientation, position)
+        self.cache.put(key, symmetry.map_solution(solution) if symmetry else solution)
+
+    def solve(self, cube, budget = None, orientation = SCANNED, position = SOLVE_START):
+        # with a budget the fastest solution found in budget seconds for the robot starting in orientation
+        # with the flipper at position is kept
+        start = orientation if budget is not None else None
+        solution = self.lookup(cube, start, position)
+        if solution is None:
+            if self.warming:
+                wait_for_warm_up(self.warming)
+            if budget is None:
+                solution = self.solve_fn(cube)
+            else:
+                solution = report_fastest(*fastest_solution(self.solve_fn, cube, budget=budget, orientation=orientation, position=position))
+            self.remember(cube, solution, start, position)
+        return solution
+
+
+class SolverPool:
+    # solves in a worker process so the event loop keeps reading the hub while kociemba runs
+    # cache lookups stay in this process, only misses are sent to the worker
+    def __init__(self, solver = None, workers = 1):
+        self.solver = solver if solver is not None else CachedSolver()
+        self.workers = workers
+        self.pool = None
+        # futures are settled and discarded in the pool's result thread
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.warming = None
+
+    def _submit(self, fn, *args):
+        # a future for fn(*args) run in a worker, cancelled when cancel stops the workers
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        future = concurrent.futures.Future()
+        with self.pending_lock:
+            self.pending.add(future)
+        future.add_done_callback(self._forget)
+        self.pool.apply_async(fn, args, callback=lambda result: settle(future.set_result, result),
+                              error_callback=lambda e: settle(future.set_exception, e))
+        return future
+
+    def _forget(self, future):
+        with self.pending_lock:
+            self.pending.discard(future)
+
+    async def _run(self, fn, *args):
+        return await asyncio.wrap_future(self._submit(fn, *args))
+
+    def warm_up(self):
+        # start the worker and load the solver tables there while the hub uploads, initializes and scans
+        self.warming = self._submit(timed_solve, self.solver.solve_fn, WARM_UP_CUBE)
+        self.warming.add_done_callback(report_warm_up)
+        return self.warming
+
+    async def _wait_for_warm_up(self):
+        if self.warming and not self.warming.done():
+            # wait for the tables instead of loading them a second time
+            print("Waiting for solver warm-up")
+            await asyncio.wait([asyncio.wrap_future(self.warming)])
+
+    async def _search(self, cube, rotations, timeout, orientation, position):
+        # a search that runs out of time stops the workers, the next solve would otherwise queue behind it
+        future = self._run(solve_rotations, self.solver.solve_fn, cube, rotations, orientation, position)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self.cancel()
+            raise
+
+    async def solve_anytime(self, cube, deadline = 0.3, timeout = None, batch = 4, free = 0, orientation = SCANNED, position = SOLVE_START):
+        """
+        Anytime solve: the first solution is found without a deadline (other than timeout), then
+        the search goes on with the other rotations of the cube, batch at a time. Returns the
+        solution with the lowest estimated robot time once deadline seconds have passed since the
+        call or every rotation has been tried.
+
+        The robot waits while the host searches, so after the first batch the search only goes on
+        while the robot time it saved exceeds the time it took, not counting the first free seconds
+        when the robot is busy anyway. A batch is only started when the time left fits it at the pace
+        of the solves so far. One that still runs out of time stops the worker so the next solve, such
+        as the rest of a streamed plan, does not wait for results nobody reads, and a fresh worker
+        loads its tables straight away. A batch that fails leaves the best solution found before it.
+        Plans are estimated from orientation with the flipper at position.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        solution = self.solver.lookup(cube, orientation, position)
+        if solution is not None:
+            return solution
+        await self._wait_for_warm_up()
+        solving = loop.time()
+        best = min(await self._search(cube, [0], timeout, orientation, position))
+        first = best[0]
+        searching = loop.time()
+        candidates = 1
+        # seconds per solve in the worker, the solves of a batch run one after the other
+        pace = searching - solving
+        steps = [list(range(i, min(i + batch, len(ROTATIONS)))) for i in range(1, len(ROTATIONS), batch)]
+        while steps:
+            remaining = start + deadline - loop.time()
+            if candidates > 1:
+                # only keep going for as long as the robot time saved so far pays for the search
+                remaining = min(remaining, first - best[0] - (loop.time() - searching - free))
+            if remaining <= 0 or remaining < pace * len(steps[0]):
+                break
+            try:
+                results = await self._search(cube, steps.pop(0), remaining, orientation, position)
+            except asyncio.TimeoutError:
+                self.warm_up()
+                break
+            except Exception as e:
+                print("Anytime solve stopped after %d candidates: %r" % (candidates, e))
+                break
+            candidates += len(results)
+            best = min(best, *results)
+            pace = (loop.time() - solving) / candidates
+        print("Anytime solve tried %d candidates in %.2fs, est. %.0fs instead of %.0fs" % (
+            candidates, loop.time() - start, best[0], first))
+        self.solver.remember(cube, best[1], orientation, position)
+        return best[1]
+
+    async def search_robot(self, cube, seconds, bound, timeout = None):
+        # (estimated seconds, primitives) of a plan faster than bound found by robot_search, or (bound, None),
+        # also when the search has not returned within timeout seconds
+        future = self._run(robot_solve, cube, seconds, bound)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.cancel()
+            return bound, None
+        except SolveCancelled:
+            return bound, None
+
+    def cancel(self, wait = False):
+        # a running solve cannot be interrupted, so stop the workers and start fresh ones on the next
+        # solve. the solves that were queued or running raise SolveCancelled. terminating joins the workers
+        # and the pool's threads, so unless told to wait that happens in a thread of its own and the
+        # event loop keeps reading the hub
+        if self.pool is None:
+            return
+        pool, self.pool = self.pool, None
+        if wait:
+            pool.terminate()
+        else:
+            threading.Thread(target=pool.terminate, name='solver-terminate', daemon=True).start()
+        with self.pending_lock:
+            futures = list(self.pending)
+        for future in futures:
+            settle(future.set_exception, SolveCancelled('the solver workers were stopped'))
+
+    def shutdown(self):
+        # nothing waits for the workers once the program has ended, abandoned searches included
+        self.cancel(wait=True)
@@ -0,0 +1,146 @@
+# whole cube symmetries of facelet strings
+#
+# facelet strings use the kociemba layout that scanCube produces: 9 facelets per face in U R F D L B order
+# a symmetry turns (or mirrors) the whole cube and relabels the colours so the centers match again,
+# the result is a different state with an equivalent solution
+
+import itertools
+
+FACES = 'URFDLB'
+
+# outward normal of each face, x points to R, y to U and z to F
+FACE_NORMALS = {
+    'U': (0, 1, 0),
+    'R': (1, 0, 0),
+    'F': (0, 0, 1),
+    'D': (0, -1, 0),
+    'L': (-1, 0, 0),
+    'B': (0, 0, -1),
+}
+
+
+def facelet_positions():
+    # (position, normal) of each of the 54 facelets, faces are read row by row as seen from outside
+    facelets = []
+    for face in FACES:
+        for row in range(3):
+            for col in range(3):
+                a, b = row - 1, col - 1
+                if face == 'U':
+                    pos = (b, 1, a)
+                elif face == 'R':
+                    pos = (1, -a, -b)
+                elif face == 'F':
+                    pos = (b, -a, 1)
+                elif face == 'D':
+                    pos = (b, -1, -a)
+                elif face == 'L':
+                    pos = (-1, -a, b)
+                else:
+                    pos = (-b, -a, -1)
+                facelets.append((pos, FACE_NORMALS[face]))
+    return facelets
+
+
+def transform_vector(matrix, v):
+    return tuple(sum(matrix[r][c] * v[c] for c in range(3)) for r in range(3))
+
+
+def determinant(m):
+    return (m[0][0] * (m[1][1] * m[2][2] - m[1][2] * m[2][1])
+            - m[0][1] * (m[1][0] * m[2][2] - m[1][2] * m[2][0])
+            + m[0][2] * (m[1][0] * m[2][1] - m[1][1] * m[2][0]))
+
+
+def face_of(normal):
+    for face, n in FACE_NORMALS.items():
+        if n == normal:
+            return face
+
+
+class Symmetry:
+    def __init__(self, matrix):
+        self.matrix = matrix
+        self.mirror = determinant(matrix) < 0
+        # faces[X] is where face X ends up
+        self.faces = {face: face_of(transform_vector(matrix, n)) for face, n in FACE_NORMALS.items()}
+        self.colours = str.maketrans(self.faces)
+        facelets = facelet_positions()
+        index = {f: i for i, f in enumerate(facelets)}
+        # source[i] is the facelet that moves to position i
+        self.source = [0] * 54
+        for i, (pos, normal) in enumerate(facelets):
+            self.source[index[(transform_vector(matrix, pos), transform_vector(matrix, normal))]] = i
+        # mirroring reverses the direction of every quarter turn
+        self.moves = {}
+        for face in FACES:
+            target = self.faces[face]
+            clockwise, counter = (target + "'", target) if self.mirror else (target, target + "'")
+            self.moves[face] = clockwise
+            self.moves[face + "'"] = counter
+            self.moves[face + "2"] = target + "2"
+
+    def apply(self, cube):
+        # the cube turned by this symmetry, with colours relabeled to follow the centers
+        return ''.join([cube[i] for i in self.source]).translate(self.colours)
+
+    def map_solution(self, solution):
+        # a solution of cube turned into a solution of apply(cube)
+        return ' '.join(self.moves[move] for move in solution.split())
+
+
+def _symmetries():
+    # the 48 signed permutation matrices, identity first
+    matrices = []
+    for perm in itertools.permutations(range(3)):
+        for signs in itertools.product((1, -1), repeat=3):
+            matrices.append(tuple(tuple(signs[r] if c == perm[r] else 0 for c in range(3)) for r in range(3)))
+    matrices.sort(key=lambda m: m != ((1, 0, 0), (0, 1, 0), (0, 0, 1)))
+    return [Symmetry(m) for m in matrices]
+
+
+SYMMETRIES = _symmetries()
+# the 24 symmetries that are real whole cube rotations
+ROTATIONS = [s for s in SYMMETRIES if not s.mirror]
+
+
+def inverse(symmetry):
+    transposed = tuple(tuple(symmetry.matrix[c][r] for c in range(3)) for r in range(3))
+    for s in SYMMETRIES:
+        if s.matrix == transposed:
+            return s
+
+
+for symmetry in SYMMETRIES:
+    symmetry.inverse = inverse(symmetry)
+
+
+def _face_turns():
+    # source[i] is the facelet that moves to position i in a clockwise quarter turn of each face
+    facelets = facelet_positions()
+    index = {f: i for i, f in enumerate(facelets)}
+    turns = {}
+    for face, (x, y, z) in FACE_NORMALS.items():
+        # clockwise seen from outside is -90 degrees about the outward normal
+        matrix = ((x * x, z, -y), (-z, y * y, x), (y, -x, z * z))
+        source = list(range(54))
+        for i, (pos, normal) in enumerate(facelets):
+            if sum(p * n for p, n in zip(pos, (x, y, z))) == 1:
+                source[index[(transform_vector(matrix, pos), transform_vector(matrix, normal))]] = i
+        turns[face] = source
+    return turns
+
+
+FACE_TURNS = _face_turns()
+
+
+def canonicalize(cube, symmetries = SYMMETRIES):
+    # the smallest equivalent facelet string and the symmetry that produces it from cube
+    best = cube
+    best_symmetry = symmetries[0]
+    for s in symmetries:
+        candidate = s.apply(cube)
+        if candidate < best:
+            best = candidate
+            best_symmetry = s
+    return best, best_symmetry
@@ -0,0 +1,276 @@
+# compiles kociemba face turn solutions into the robot's own primitives
+#
+# the robot can only turn the bottom layer, so every face turn first brings that face down.
+# the *Move functions in cube_bot.py do this and then put the cube back in its home orientation
+# after every turn. the compiler instead keeps track of where each face currently is and picks the
+# cheapest reorientation for the whole solution.
+#
+# primitives are written in the solution notation, encode_plan packs a plan into one byte per
+# primitive (op * 4 + quarter turns) and runPlan in cube_bot.py runs the bytes:
+#   X  flipX(1)     X2 flipX(2)     X' flipX(3)
+#   Y  rotateY(1)   Y2 rotateY(2)   Y' rotateY(1, prime)
+#   D  turnD(1)     D2 turnD(2)     D' turnD(1, prime)
+
+import collections, heapq
+
+FACES = 'URFDLB'
+# an orientation lists the face at each position, in U R F D L B position order
+HOME = tuple(FACES)
+UP, RIGHT, FRONT, DOWN, LEFT, BACK = range(6)
+
+# rough durations in seconds used when no cost model is given, see robot_timing.py for the calibrated ones
+PRIMITIVE_SECONDS = {
+    'X': 1.2, 'X2': 2.4, "X'": 3.6,
+    'Y': 0.5, 'Y2': 0.8, "Y'": 0.5,
+    'D': 0.7, 'D2': 1.0, "D'": 0.7,
+}
+
+# the moves performed by uMove, fMove ... in cube_bot.py, each starts and ends in the home orientation
+MOVE_MACROS = {
+    'U': ['X2', 'D', 'X2'],
+    'F': ['Y2', 'X', 'D', 'Y2', 'X'],
+    'B': ['X', 'D', "X'"],
+    'R': ["Y'", 'X', 'D', 'Y2', 'X', "Y'"],
+    'L': ['Y', 'X', 'D', 'Y2', 'X', 'Y'],
+    'D': ['D'],
+}
+
+
+def flip(o):
+    # flipX: the front face goes up, the top to the back, the back down and the bottom to the front
+    return (o[FRONT], o[RIGHT], o[DOWN], o[BACK], o[LEFT], o[UP])
+
+
+def rotate(o):
+    # rotateY regular: the right face goes to the front, the front left, the left back and the back right
+    return (o[UP], o[BACK], o[RIGHT], o[DOWN], o[FRONT], o[LEFT])
+
+
+def apply_primitive(o, primitive):
+    if primitive[0] == 'X':
+        turns = {'X': 1, 'X2': 2, "X'": 3}[primitive]
+        step = flip
+    elif primitive[0] == 'Y':
+        turns = {'Y': 1, 'Y2': 2, "Y'": 3}[primitive]
+        step = rotate
+    else:
+        # turning the bottom layer leaves the orientation alone
+        return o
+    for _ in range(turns):
+        o = step(o)
+    return o
+
+
+def split_move(move):
+    # 'R2' -> ('R', '2')
+    return move[0], move[1:]
+
+
+def _orientations():
+    seen = {HOME}
+    todo = [HOME]
+    while todo:
+        o = todo.pop()
+        for n in (flip(o), rotate(o)):
+            if n not in seen:
+                seen.add(n)
+                todo.append(n)
+    return sorted(seen)
+
+
+ORIENTATIONS = _orientations()
+
+
+def apply_plan(o, plan):
+    for primitive in plan:
+        o = apply_primitive(o, primitive)
+    return o
+
+
+# scanCube used to end with these moves to put the cube back home, it now sends the state before them
+# so the hub runs them only for plain face move solutions. compiled plans start from SCANNED instead.
+RESTORE = ['Y2', 'X', "Y'"]
+SCANNED = next(o for o in ORIENTATIONS if apply_plan(o, RESTORE) == HOME)
+
+
+class MoveCompiler:
+    def __init__(self, cost = None):
+        # cost(primitive) in seconds, the reorientation steps considered are X, Y, Y' and Y2
+        self.cost = cost if cost is not None else PRIMITIVE_SECONDS.get
+        self.paths = {o: self._shortest_paths(o) for o in ORIENTATIONS}
+
+    def _shortest_paths(self, start):
+        # cheapest reorientation from start to every orientation as (seconds, primitives)
+        best = {start: (0, [])}
+        queue = [(0, 0, start, [])]
+        counter = 1
+        while queue:
+            seconds, _, o, path = heapq.heappop(queue)
+            if seconds > best[o][0]:
+                continue
+            for step in ('X', 'Y', "Y'", 'Y2'):
+                n = apply_primitive(o, step)
+                n_path = merge(path + [step])
+                n_seconds = sum(self.cost(p) for p in n_path)
+                if n not in best or n_seconds < best[n][0]:
+                    best[n] = (n_seconds, n_path)
+                    heapq.heappush(queue, (n_seconds, counter, n, n_path))
+                    counter += 1
+        return best
+
+    def compile(self, solution, start = HOME):
+        # returns the primitive list for solution starting with the cube in the start orientation
+        moves = solution.split()
+        # states maps each reachable orientation to (seconds, previous orientation, primitives from it)
+        layers = [{start: (0, None, [])}]
+        for move in moves:
+            face, suffix = split_move(move)
+            turn = 'D' + suffix
+            layer = {}
+            for o, (seconds, _, _) in layers[-1].items():
+                for target, (reorient, path) in self.paths[o].items():
+                    if target[DOWN] != face:
+                        continue
+                    total = seconds + reorient + self.cost(turn)
+                    if target not in layer or total < layer[target][0]:
+                        layer[target] = (total, o, path + [turn])
+            layers.append(layer)
+        # walk back from the cheapest final orientation, the cube does not need to end at home
+        o = min(layers[-1], key=lambda o: layers[-1][o][0])
+        plan = []
+        for layer in reversed(layers[1:]):
+            seconds, previous, primitives = layer[o]
+            plan = primitives + plan
+            o = previous
+        return plan
+
+    def seconds(self, plan):
+        return sum(self.cost(p) for p in plan)
+
+
+# intermediate representation of a primitive, op is X, Y or D and turns counts quarter turns 1-3
+# (flips only go one way, so X turns are repeated flips while Y and D 3 is a -90 turn)
+Primitive = collections.namedtuple('Primitive', 'op turns')
+
+SUFFIXES = ['', '', '2', "'"]
+
+
+def quarter_turns(primitive):
+    return {'': 1, '2': 2, "'": 3}[primitive[1:]]
+
+
+def parse_plan(plan):
+    if isinstance(plan, str):
+        plan = plan.split()
+    return [Primitive(p[0], quarter_turns(p)) for p in plan]
+
+
+def format_plan(primitives):
+    return [p.op + SUFFIXES[p.turns] for p in primitives]
+
+
+# one byte per primitive for the hub, op * 4 + quarter turns (runPlan in cube_bot.py)
+OPCODES = 'XYD'
+
+
+def encode_plan(plan):
+    return bytes(OPCODES.index(p.op) * 4 + p.turns for p in parse_plan(plan))
+
+
+def decode_plan(data):
+    return format_plan(Primitive(OPCODES[code >> 2], code & 3) for code in data)
+
+
+def _push(out, primitive):
+    # append primitive, merging it into the previous one when they turn about the same axis the same way
+    turns = primitive.turns % 4
+    while out and out[-1].op == primitive.op:
+        turns = (turns + out.pop().turns) % 4
+    if turns:
+        out.append(Primitive(primitive.op, turns))
+
+
+def merge(path):
+    # combine neighbouring primitives of the same kind, X X -> X2, Y Y' -> nothing
+    out = []
+    for p in parse_plan(path):
+        _push(out, p)
+    return format_plan(out)
+
+
+def peephole(plan):
+    """
+    Removes waste from a primitive plan: flips and rotations are merged mod 4, so X2 X2 and Y2 Y2
+    disappear and X3 becomes X', and rotations are moved past bottom turns. Y and D turn about the
+    same axis so they commute: every run of Y and D between two flips collapses to one Y and one D,
+    which can leave neighbouring flips next to each other to merge again.
+    """
+    out = []
+    segment = {'Y': 0, 'D': 0}
+
+    def flush():
+        for op in ('Y', 'D'):
+            if segment[op] % 4:
+                _push(out, Primitive(op, segment[op]))
+            segment[op] = 0
+
+    for p in parse_plan(plan):
+        if p.op == 'X':
+            flush()
+            _push(out, p)
+            # a flip that cancelled out leaves the rotations and turns on both sides of it together
+            while out and out[-1].op != 'X':
+                q = out.pop()
+                segment[q.op] += q.turns
+        else:
+            segment[p.op] += p.turns
+    flush()
+    return format_plan(out)
+
+
+def split_plan(plan, turns):
+    # (the primitives up to and including the turns-th bottom turn, the rest)
+    for i, p in enumerate(plan):
+        if p[0] == 'D':
+            turns -= 1
+            if turns == 0:
+                return plan[:i + 1], plan[i + 1:]
+    return plan, []
+
+
+def expand_solution(solution):
+    # the primitives the *Move functions run for solution, one macro per face turn
+    plan = []
+    for move in solution.split():
+        face, suffix = split_move(move)
+        plan.extend(p + suffix if p == 'D' else p for p in MOVE_MACROS[face])
+    return plan
+
+
+def plan_moves(plan, start = HOME):
+    # the face turn solution a plan performs from the start orientation, each bottom turn turns the
+    # face that is down at the time
+    moves = []
+    o = start
+    for primitive in plan:
+        if primitive[0] == 'D':
+            moves.append(o[DOWN] + primitive[1:])
+        else:
+            o = apply_primitive(o, primitive)
+    return ' '.join(moves)
+
+
+def compile_solution(solution, start = HOME, compiler = None):
+    # plan string for solveCube on the hub
+    compiler = compiler if compiler is not None else default_compiler()
+    return ' '.join(peephole(compiler.compile(solution, start)))
+
+
+_default = None
+
+def default_compiler():
+    global _default
+    if _default is None:
+        from robot_timing import default_model
+        _default = MoveCompiler(default_model().cost)
+    return _default
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# plans a rescan of a few tiles instead of running scanCube again
+#
+# the colour sensor looks down on the top of the cube. scanFace reads the center at flipperScanCenter,
+# then turns the cube 45 degrees at a time and reads the ring of tiles 8 9 6 3 2 1 4 7 alternately at
+# flipperScanEdge and flipperScanCorner. so with the cube square in the robot the sensor reads the
+# tile in the U5 spot at the center position and the one in the U8 spot at the edge position, and
+# with the cube turned another 45 degrees the tile that was in the U9 spot at the corner position.
+#
+# the planner searches the cheapest sequence of flips, rotations, 45 degree steps and reads that
+# visits only the requested tiles, costed with the robot_timing model, and leaves the cube square so
+# the solution plan can start from wherever it ends.
+#
+# python3 rescan_planner.py U8 F3 B1
+
+import argparse, functools, heapq
+from cube_colors import tile_name
+from cube_symmetry import FACES, ROTATIONS
+from move_compiler import SCANNED, apply_primitive
+from robot_timing import SOLVE_START, default_model
+
+# facelet spot of the U face read at each flipper position, the corner one after a further 45 degrees
+SENSOR_SPOTS = {'scan_center': 4, 'scan_edge': 7, 'scan_corner': 8}
+# rescan steps that turn the cube 45 degrees, as rotaterMotor.run_for_degrees(45) in scanFace and back
+STEPS = {'+': 45, '-': -45}
+REORIENT = ['X', 'X2', "X'", 'Y', 'Y2', "Y'"]
+
+
+@functools.lru_cache(maxsize=None)
+def readable(o):
+    # {flipper position: facelet under the sensor} with the cube square in orientation o, the
+    # scan_corner one for the cube turned a further 45 degrees
+    rotation = next(s for s in ROTATIONS if all(s.faces[o[p]] == FACES[p] for p in range(6)))
+    return {position: rotation.source[spot] for position, spot in SENSOR_SPOTS.items()}
+
+
+def plan_rescan(tiles, start = SCANNED, position = SOLVE_START, model = None):
+    """
+    Returns (estimated seconds, steps, orientation, flipper position) of the cheapest way to read
+    tiles (facelet indexes 0-53) again, starting square in orientation start with the flipper at
+    position and ending square in orientation. steps are primitives, '+' and '-' for 45 degree
+    turns and [tile, flipper position] for a read.
+    """
+    model = model if model is not None else default_model()
+    step_seconds = model.rotater_seconds(45)
+    targets = sorted(set(tiles))
+    bit = {tile: 1 << i for i, tile in enumerate(targets)}
+    # a state is (orientation, turned 45 degrees, flipper position, tiles still to read)
+    first = (start, False, position, (1 << len(targets)) - 1)
+    best = {first: 0}
+    previous = {}
+    queue = [(0, 0, first)]
+    counter = 1
+    while queue:
+        seconds, _, state = heapq.heappop(queue)
+        if seconds > best[state]:
+            continue
+        o, turned, at, todo = state
+        if not todo and not turned:
+            break
+        moves = []
+        for spot, tile in readable(o).items():
+            if (spot == 'scan_corner') == turned and bit.get(tile, 0) & todo:
+                moves.append(([tile, spot], model.flipper_seconds(at, spot) + model.overhead, (o, turned, spot, todo & ~bit[tile])))
+        # a quarter more than 45 degrees is the next square orientation
+        moves.append(('+', step_seconds, (apply_primitive(o, 'Y'), False, at, todo) if turned else (o, True, at, todo)))
+        moves.append(('-', step_seconds, (o, False, at, todo) if turned else (apply_primitive(o, "Y'"), True, at, todo)))
+        if not turned:
+            for p in REORIENT:
+                cost, after = model.table[at][p]
+                moves.append((p, cost, (apply_primitive(o, p), False, after, todo)))
+        for step, cost, n in moves:
+            if n not in best or seconds + cost < best[n]:
+                best[n] = seconds + cost
+                previous[n] = (state, step)
+                heapq.heappush(queue, (seconds + cost, counter, n))
+                counter += 1
+    steps = []
+    end = state
+    while state != first:
+        state, step = previous[state]
+        steps.append(step)
+    return best[end], steps[::-1], end[0], end[2]
+
+
+def format_steps(steps):
+    return ' '.join(step if isinstance(step, str) else 'read ' + tile_name(step[0]) for step in steps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Plan a rescan of some tiles after scanCube')
+    parser.add_argument('tiles', help='tiles to read again, U1 .. B9', nargs='+')
+    args = parser.parse_args()
+    tiles = [FACES.index(t[0]) * 9 + int(t[1]) - 1 for t in args.tiles]
+    seconds, steps, orientation, position = plan_rescan(tiles)
+    print("%s (est. %.1fs, ends in %s with the flipper at %s)" % (format_steps(steps), seconds, ''.join(orientation), position))
@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+
+# optional solver that searches the robot's own primitives instead of face turns
+#
+# kociemba finds solutions that are short in face turns and the compiler then adds the flips and
+# rotations. this solver instead searches sequences of X, Y and D primitives directly, costs them with
+# robot_timing and keeps the solution the robot runs fastest. like kociemba it works in two phases:
+# phase 1 brings the cube into <U, D, R2, L2, F2, B2> and phase 2 solves it with those moves.
+#
+# the pruning tables hold a lower bound of the robot time left in a phase for every coordinate and
+# orientation of the cube in the robot. they need numpy, are built once (a few minutes) and are
+# memory mapped from ~/.cubebot/robot_tables afterwards. they are built again when the timing model
+# changes, e.g. after python3 robot_timing.py --fit.
+#
+# python3 robot_search.py --build
+# python3 robot_search.py DRLUUBFBRBLURRLRUBLRDDFDLFUFUFFDBRDUBRUFLLFDDBFLUBLRBD
+
+import argparse, heapq, itertools, json, math, os, time
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from cube_model import CORNER_COLOURS, CORNER_FACELETS, EDGE_COLOURS, EDGE_FACELETS
+from move_compiler import DOWN, FACES, ORIENTATIONS, SCANNED, apply_primitive
+from robot_timing import SOLVE_START, default_model
+
+TABLE_DIR = os.path.expanduser('~/.cubebot/robot_tables')
+
+# pruning tables store robot time in steps of UNIT seconds, rounded down so they stay lower bounds
+UNIT = 0.2
+# the timing model factors the tables were built with, they are only lower bounds for that model
+MODEL_FILE = 'model.json'
+
+# the cubies in kociemba's order
+# corners URF UFL ULB UBR DFR DLF DBL DRB, edges UR UF UL UB DR DF DL DB FR FL BL BR
+# each face turn as (corner permutation, corner twist, edge permutation, edge flip)
+BASIC_MOVES = {
+    'U': ([3, 0, 1, 2, 4, 5, 6, 7], [0, 0, 0, 0, 0, 0, 0, 0],
+          [3, 0, 1, 2, 4, 5, 6, 7, 8, 9, 10, 11], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]),
+    'R': ([4, 1, 2, 0, 7, 5, 6, 3], [2, 0, 0, 1, 1, 0, 0, 2],
+          [8, 1, 2, 3, 11, 5, 6, 7, 4, 9, 10, 0], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]),
+    'F': ([1, 5, 2, 3, 0, 4, 6, 7], [1, 2, 0, 0, 2, 1, 0, 0],
+          [0, 9, 2, 3, 4, 8, 6, 7, 1, 5, 10, 11], [0, 1, 0, 0, 0, 1, 0, 0, 1, 1, 0, 0]),
+    'D': ([0, 1, 2, 3, 5, 6, 7, 4], [0, 0, 0, 0, 0, 0, 0, 0],
+          [0, 1, 2, 3, 5, 6, 7, 4, 8, 9, 10, 11], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]),
+    'L': ([0, 2, 6, 3, 4, 1, 5, 7], [0, 1, 2, 0, 0, 2, 1, 0],
+          [0, 1, 10, 3, 4, 5, 9, 7, 8, 2, 6, 11], [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]),
+    'B': ([0, 1, 3, 7, 4, 5, 2, 6], [0, 0, 1, 2, 0, 0, 2, 1],
+          [0, 1, 2, 11, 4, 5, 6, 10, 8, 9, 3, 7], [0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 1, 1]),
+}
+
+# coordinate sizes
+TWISTS, FLIPS, SLICES, PERMS, SLICE_PERMS = 2187, 2048, 495, 40320, 24
+# positions of the four slice edges FR FL BL BR when they are in the slice
+SLICE_GOAL = 494
+
+# the robot primitives, D turns the face that is currently down
+PRIMITIVES = ['X', 'X2', "X'", 'Y', 'Y2', "Y'", 'D', 'D2', "D'"]
+TURNS = {'': 1, '2': 2, "'": 3}
+# primitives allowed after each one: repeating one would merge and rotations commute with bottom
+# turns, so they always come before them
+FOLLOWERS = {
+    None: PRIMITIVES,
+    'X': ['Y', 'Y2', "Y'", 'D', 'D2', "D'"],
+    'Y': ['X', 'X2', "X'", 'D', 'D2', "D'"],
+    'D': ['X', 'X2', "X'"],
+}
+
+
+def multiply(a, b):
+    # the cubie cube a followed by b
+    cp, co, ep, eo = a
+    bcp, bco, bep, beo = b
+    return ([cp[i] for i in bcp], [(co[bcp[i]] + bco[i]) % 3 for i in range(8)],
+            [ep[i] for i in bep], [(eo[bep[i]] + beo[i]) % 2 for i in range(12)])
+
+
+SOLVED = (list(range(8)), [0] * 8, list(range(12)), [0] * 12)
+
+
+def _face_moves():
+    # the 18 face turns, index face * 3 + quarter turns - 1
+    moves = []
+    for face in FACES:
+        cube = SOLVED
+        for _ in range(3):
+            cube = multiply(cube, BASIC_MOVES[face])
+            moves.append(cube)
+    return moves
+
+
+FACE_MOVES = _face_moves()
+# face turns that keep a cube in phase 2
+PHASE2_MOVES = [m for m in range(18) if m // 3 in (0, 3) or m % 3 == 1]
+
+
+def cubie_cube(cube):
+    # the facelet string as cubies, raises ValueError for impossible cubes
+    cp, co, ep, eo = [None] * 8, [0] * 8, [None] * 12, [0] * 12
+    for i, facelets in enumerate(CORNER_FACELETS):
+        colours = ''.join(cube[f] for f in facelets)
+        for twist in range(3):
+            if colours[twist] in 'UD':
+                break
+        turned = colours[twist:] + colours[:twist]
+        if turned not in CORNER_COLOURS:
+            raise ValueError('impossible corner %s' % colours)
+        cp[i], co[i] = CORNER_COLOURS.index(turned), twist
+    for i, facelets in enumerate(EDGE_FACELETS):
+        colours = ''.join(cube[f] for f in facelets)
+        if colours in EDGE_COLOURS:
+            ep[i] = EDGE_COLOURS.index(colours)
+        elif colours[::-1] in EDGE_COLOURS:
+            ep[i], eo[i] = EDGE_COLOURS.index(colours[::-1]), 1
+        else:
+            raise ValueError('impossible edge %s' % colours)
+    if sorted(cp) != list(range(8)) or sorted(ep) != list(range(12)) or sum(co) % 3 or sum(eo) % 2:
+        raise ValueError('cube cannot be solved')
+    return cp, co, ep, eo
+
+
+# coordinates, encoded for whole arrays of cubies at once so the move tables are quick to build
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError('robot_search needs numpy, install it with pip3 install numpy')
+
+
+def encode_twist(co):
+    return co[:, :7] @ (3 ** np.arange(6, -1, -1))
+
+
+def encode_flip(eo):
+    return eo[:, :11] @ (2 ** np.arange(10, -1, -1))
+
+
+def encode_slice(occupied):
+    # colex rank of the four positions holding slice edges
+    positions = np.nonzero(occupied)[1].reshape(-1, 4)
+    comb = np.array([[math.comb(n, k) for k in range(5)] for n in range(12)])
+    return sum(comb[positions[:, k], k + 1] for k in range(4))
+
+
+def encode_perm(perm):
+    # rank of each permutation in lexicographic order
+    n = perm.shape[1]
+    rank = np.zeros(len(perm), dtype=np.int64)
+    for i in range(n):
+        rank += (perm[:, i + 1:] < perm[:, i:i + 1]).sum(axis=1) * math.factorial(n - 1 - i)
+    return rank
+
+
+def all_twists():
+    digits = np.array(list(itertools.product(range(3), repeat=7)))
+    return np.hstack([digits, (-digits.sum(axis=1) % 3)[:, None]])
+
+
+def all_flips():
+    digits = np.array(list(itertools.product(range(2), repeat=11)))
+    return np.hstack([digits, (digits.sum(axis=1) % 2)[:, None]])
+
+
+def all_slices():
+    occupied = np.zeros((SLICES, 12), dtype=bool)
+    for i, positions in enumerate(itertools.combinations(range(12), 4)):
+        occupied[i, list(positions)] = True
+    ranked = np.zeros_like(occupied)
+    ranked[encode_slice(occupied)] = occupied
+    return ranked
+
+
+def move_tables():
+    # new coordinate = table[coordinate, face move], -1 for moves that leave phase 2
+    _require_numpy()
+    twists, flips, slices = all_twists(), all_flips(), all_slices()
+    perms8 = np.array(list(itertools.permutations(range(8))))
+    perms4 = np.array(list(itertools.permutations(range(4))))
+    tables = {name: np.full((size, 18), -1, dtype=np.int32) for name, size in
+              (('twist', TWISTS), ('flip', FLIPS), ('slice', SLICES), ('corners', PERMS), ('edges', PERMS), ('slice_perm', SLICE_PERMS))}
+    for m, (cp, co, ep, eo) in enumerate(FACE_MOVES):
+        cp, co, ep, eo = (np.array(x) for x in (cp, co, ep, eo))
+        tables['twist'][:, m] = encode_twist((twists[:, cp] + co) % 3)
+        tables['flip'][:, m] = encode_flip((flips[:, ep] + eo) % 2)
+        tables['slice'][:, m] = encode_slice(slices[:, ep])
+        tables['corners'][:, m] = encode_perm(perms8[:, cp])
+        if m in PHASE2_MOVES:
+            tables['edges'][:, m] = encode_perm(perms8[:, ep[:8]])
+            tables['slice_perm'][:, m] = encode_perm(perms4[:, ep[8:] - 8])
+    return tables
+
+
+def orientation_tables():
+    # next orientation for each primitive and the face at the bottom, by orientation index
+    index = {o: i for i, o in enumerate(ORIENTATIONS)}
+    moves = {p: [index[apply_primitive(o, p)] for o in ORIENTATIONS] for p in PRIMITIVES}
+    down = [FACES.index(o[DOWN]) for o in ORIENTATIONS]
+    return moves, down
+
+
+def heuristic_costs(model, start = SOLVE_START):
+    """
+    The least each primitive costs in a plan, in seconds: the cheapest over every flipper position
+    a plan starting at start can run it from. Plans start wherever the scan left the flipper, where
+    a bottom turn is cheaper than after a flip, so a minimum over flipperFlip alone is no lower bound.
+    """
+    positions = {start}
+    todo = [start]
+    while todo:
+        for seconds, position in model.table[todo.pop()].values():
+            if position not in positions:
+                positions.add(position)
+                todo.append(position)
+    return {p: min(model.table[position][p][0] for position in positions) for p in PRIMITIVES}
+
+
+def build_pruning(move_a, move_b, size_b, goal, phase2, model, step = 0.01):
+    """
+    Lower bound of the robot time, in UNITs, to reach goal from every (a * size_b + b) * 24 + orientation
+    state, where a and b are coordinates with move tables move_a and move_b. Dijkstra from the goal
+    states backwards over the primitives, with costs in steps of step seconds.
+    """
+    orientation_moves, down = orientation_tables()
+    down = np.array(down)
+    ud = (down == 0) | (down == 3)
+    costs = {p: int(seconds / step) for p, seconds in heuristic_costs(model).items()}
+    inverse = {p: np.argsort(orientation_moves[p]) for p in PRIMITIVES}
+    dist = np.full(len(move_a) * size_b * 24, np.iinfo(np.int32).max, dtype=np.int32)
+    goal_states = np.arange(goal * 24, (goal + 1) * 24)
+    dist[goal_states] = 0
+    # states to expand by distance, entries are stale when a shorter distance was found later
+    buckets = {0: [goal_states]}
+    while buckets:
+        level = min(buckets)
+        frontier = np.unique(np.concatenate(buckets.pop(level)))
+        frontier = frontier[dist[frontier] == level]
+        coordinate, o = np.divmod(frontier, 24)
+        a, b = np.divmod(coordinate, size_b)
+        for p in PRIMITIVES:
+            if p[0] == 'D':
+                turns = TURNS[p[1:]]
+                keep = (ud | (turns == 2))[o] if phase2 else slice(None)
+                m = down[o[keep]] * 3 + 3 - turns
+                previous = (move_a[a[keep], m] * size_b + move_b[b[keep], m]) * 24 + o[keep]
+            else:
+                previous = coordinate * 24 + inverse[p][o]
+            cost = level + costs[p]
+            previous = previous[dist[previous] > cost]
+            if len(previous):
+                dist[previous] = cost
+                buckets.setdefault(cost, []).append(previous)
+    return np.minimum(dist // round(UNIT / step), 255).astype(np.uint8)
+
+
+TABLES = {
+    # name: (first coordinate, second coordinate, goal, phase 2)
+    'twist_slice': ('twist', 'slice', SLICE_GOAL, False),
+    'flip_slice': ('flip', 'slice', SLICE_GOAL, False),
+    'corners_slice': ('corners', 'slice_perm', 0, True),
+    'edges_slice': ('edges', 'slice_perm', 0, True),
+}
+PHASE1_COORDINATES = ('twist', 'flip', 'slice')
+PHASE2_COORDINATES = ('corners', 'edges', 'slice_perm')
+
+
+def tables_built(path = TABLE_DIR, model = None):
+    # whether the tables exist and were built for model, after robot_timing.py --fit faster speeds
+    # would make the old bounds overestimate and the search could prune the fastest plan
+    model = model if model is not None else default_model()
+    if not all(os.path.exists(os.path.join(path, name + '.npy')) for name in TABLES):
+        return False
+    try:
+        with open(os.path.join(path, MODEL_FILE)) as f:
+            return json.load(f) == list(model.factors())
+    except (OSError, ValueError):
+        return False
+
+
+def build_tables(path = TABLE_DIR, model = None):
+    model = model if model is not None else default_model()
+    moves = move_tables()
+    os.makedirs(path, exist_ok=True)
+    for name, (a, b, goal, phase2) in TABLES.items():
+        start = time.time()
+        table = build_pruning(moves[a], moves[b], len(moves[b]), goal, phase2, model)
+        np.save(os.path.join(path, name + '.npy'), table)
+        print("Built %s pruning table in %.0fs" % (name, time.time() - start))
+    # written last, tables left half built by an interrupted build are not taken for current ones
+    with open(os.path.join(path, MODEL_FILE), 'w') as f:
+        json.dump(list(model.factors()), f)
+
+
+def phase1_coordinates(cubie):
+    cp, co, ep, eo = cubie
+    return (int(encode_twist(np.array([co]))[0]), int(encode_flip(np.array([eo]))[0]),
+            int(encode_slice(np.array([[e >= 8 for e in ep]]))[0]))
+
+
+def phase2_coordinates(cubie):
+    cp, co, ep, eo = cubie
+    return (int(encode_perm(np.array([cp]))[0]), int(encode_perm(np.array([ep[:8]]))[0]),
+            int(encode_perm(np.array([[e - 8 for e in ep[8:]]]))[0]))
+
+
+def unwind(path):
+    # the (primitive, face move) pairs of a linked (primitive, face move, parent) path, first one first
+    steps = []
+    while path:
+        steps.append(path[:2])
+        path = path[2]
+    return steps[::-1]
+
+
+class RobotSolver:
+    """
+    Two phase search over robot primitives, costed with a robot_timing model.
+
+    Both phases are weighted best first searches: states are expanded by robot time so far plus
+    weight times the pruning table bound. A weight above 1 finds plans much sooner than an exact
+    search would in Python, at the price of plans up to weight times slower than the best. Every
+    phase 1 solution found is completed with phase 2 while time is left and the fastest plan wins.
+    """
+    def __init__(self, path = TABLE_DIR, model = None, weight = 1.5):
+        _require_numpy()
+        self.model = model if model is not None else default_model()
+        self.weight = weight
+        if not tables_built(path, self.model):
+            build_tables(path, self.model)
+        # memoryviews over the memory mapped arrays index faster than numpy does
+        self.prune = {name: memoryview(np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) for name in TABLES}
+        self.moves = {name: table.tolist() for name, table in move_tables().items()}
+        self.orientation_moves, self.down = orientation_tables()
+
+    def h1(self, twist, flip, slice_, o):
+        return max(self.prune['twist_slice'][(twist * SLICES + slice_) * 24 + o],
+                   self.prune['flip_slice'][(flip * SLICES + slice_) * 24 + o]) * UNIT
+
+    def h2(self, corners, edges, slice_perm, o):
+        return max(self.prune['corners_slice'][(corners * SLICE_PERMS + slice_perm) * 24 + o],
+                   self.prune['edges_slice'][(edges * SLICE_PERMS + slice_perm) * 24 + o]) * UNIT
+
+    def successors(self, last, o, position, phase2):
+        # (primitive, seconds, orientation, position, face move or None) that may follow last
+        table = self.model.table[position]
+        for p in FOLLOWERS[last]:
+            seconds, after = table[p]
+            if p[0] == 'D':
+                face = self.down[o]
+                turns = TURNS[p[1:]]
+                if phase2 and face not in (0, 3) and turns != 2:
+                    continue
+                yield p, seconds, o, after, face * 3 + turns - 1
+            else:
+                yield p, seconds, self.orientation_moves[p][o], after, None
+
+    def search(self, coordinates, o, last, position, phase2, offset):
+        # yields (seconds, [(primitive, face move)], final state) for every goal reached, pruning
+        # anything that cannot beat the best plan once offset seconds are added
+        names = PHASE2_COORDINATES if phase2 else PHASE1_COORDINATES
+        move_a, move_b, move_c = (self.moves[name] for name in names)
+        h = self.h2 if phase2 else self.h1
+        goal = (0, 0, 0) if phase2 else (0, 0, SLICE_GOAL)
+        weight = self.weight
+        heap = [(weight * h(*coordinates, o), 0, 0, coordinates + (o, last, position), None)]
+        seen = {}
+        counter = 1
+        while heap and time.time() < self.deadline:
+            _, seconds, _, state, path = heapq.heappop(heap)
+            a, b, c, o, last, position = state
+            if (a, b, c) == goal:
+                # a phase 1 that ends in a phase 2 move would also be found shorter
+                if phase2 or path is None or (path[1] // 3 not in (0, 3) and path[1] % 3 != 1):
+                    yield seconds, unwind(path), state
+                continue
+            if seen.get(state, math.inf) <= seconds:
+                continue
+            seen[state] = seconds
+            for p, cost, n_o, n_position, m in self.successors(last, o, position, phase2):
+                n_seconds = seconds + cost
+                n = (a, b, c) if m is None else (move_a[a][m], move_b[b][m], move_c[c][m])
+                bound = h(*n, n_o)
+                if offset + n_seconds + bound >= self.best[0]:
+                    continue
+                heapq.heappush(heap, (n_seconds + weight * bound, n_seconds, counter, n + (n_o, p[0], n_position), (p, m, path)))
+                counter += 1
+
+    def solve(self, cube, timeout = 10, start = SOLVE_START, bound = math.inf):
+        """
+        Returns (estimated seconds, primitives) of the fastest plan found for cube within timeout
+        seconds that is faster than bound, for example the estimate of the compiled kociemba plan,
+        or (bound, None) when no such plan was found.
+        """
+        cubie = cubie_cube(cube)
+        self.deadline = time.time() + timeout
+        self.best = (bound, None)
+        for seconds1, path1, state in self.search(phase1_coordinates(cubie), ORIENTATIONS.index(SCANNED), None, start, False, 0):
+            phase2 = cubie
+            for p, m in path1:
+                if m is not None:
+                    phase2 = multiply(phase2, FACE_MOVES[m])
+            for seconds2, path2, _ in self.search(phase2_coordinates(phase2), *state[3:], True, seconds1):
+                self.best = (seconds1 + seconds2, [p for p, m in path1 + path2])
+                break
+        return self.best
+
+
+_default = None
+
+def default_solver():
+    global _default
+    if _default is None:
+        _default = RobotSolver()
+    return _default
+
+
+def robot_solve(cube, timeout = 10, bound = math.inf):
+    # (estimated seconds, primitives) using the tables on disk, for use in a worker process
+    return default_solver().solve(cube, timeout, bound=bound)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search robot primitives for the fastest plan to solve a cube')
+    parser.add_argument('cube', nargs='?', help='54 character facelet string')
+    parser.add_argument('--build', help='Build the pruning tables', action='store_true')
+    parser.add_argument('-t', '--timeout', help='Seconds to search', type=float, default=10)
+    args = parser.parse_args()
+    if args.build:
+        build_tables()
+    if args.cube:
+        seconds, plan = robot_solve(args.cube, args.timeout)
+        if plan is None:
+            print("No plan found within %ss" % args.timeout)
+        else:
+            print("%s (%d primitives, est. %.0fs)" % (' '.join(plan), len(plan), seconds))
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+# predicts how long the robot takes to run a solution or a compiled primitive plan
+#
+# the durations follow what cube_bot.py does for each primitive: flipX moves the flipper to
+# flipperHold and then flipperFlip and waits .5s, turnD moves it to flipperHold and turns the
+# rotater, rotateY lifts it to flipperSpin first when it is holding the cube. so the cost of a
+# primitive depends on where the flipper is, the model tracks that position through the plan.
+#
+# the motor speeds, the per command overhead and the wait after a flip are fitted to how long the
+# primitives really take: runPlan in cube_bot.py times every primitive it runs and sends the times at
+# the end, run_spike.py appends them to ~/.cubebot/primitive_times.jsonl and --fit stores the model in
+# ~/.cubebot/timing.json, e.g. {"flipper_speed": 560, "rotater_speed": 240, "overhead": 0.1, "flip_wait": 0.5}.
+# until then the defaults of TimingModel are used, which are estimates and were never measured.
+#
+# python3 robot_timing.py "R2 U' F D2 L B'"
+# python3 robot_timing.py --plan "X Y2 D' X D2"
+# python3 robot_timing.py --fit
+
+import argparse, json, math, os
+from move_compiler import RESTORE, SCANNED, decode_plan, default_compiler, expand_solution, peephole
+
+TIMING_FILE = os.path.expanduser('~/.cubebot/timing.json')
+TIMES_FILE = os.path.expanduser('~/.cubebot/primitive_times.jsonl')
+# cube_bot_pi.py runs its motors slower and waits longer after a flip, so its times are kept apart
+# from the hub's and --fit leaves them out
+PI_TIMES_FILE = os.path.expanduser('~/.cubebot/pi_primitive_times.jsonl')
+
+# flipper motor positions from cube_bot.py
+FLIPPER_POSITIONS = {
+    'home': 12,
+    'hold': 143,
+    'flip': 274,
+    'spin': 43,
+    'scan_edge': 198,
+    'scan_center': 243,
+    'scan_corner': 184,
+}
+
+# compiled plans start right after scanCube read the last tile, a corner
+SOLVE_START = 'scan_corner'
+
+PRIMITIVES = ['X', 'X2', "X'", 'Y', 'Y2', "Y'", 'D', 'D2', "D'"]
+
+
+def flipper_degrees(start, target, direction = None):
+    # run_to_position takes the shortest path unless a direction is given
+    a, b = FLIPPER_POSITIONS[start], FLIPPER_POSITIONS[target]
+    if direction == 'clockwise':
+        return (b - a) % 360
+    if direction == 'counterclockwise':
+        return (a - b) % 360
+    return min((b - a) % 360, (a - b) % 360)
+
+
+def primitive_work(position, primitive):
+    # ((motor commands, flipper degrees, rotater degrees, flips), flipper position afterwards) of a
+    # primitive, its time is linear in these with the overhead, 1 / speeds and the flip wait as factors
+    op, turns = primitive[0], {'': 1, '2': 2, "'": 3}[primitive[1:]]
+    commands = flipper = rotater = flips = 0
+    if op == 'X':
+        for _ in range(turns):
+            commands += 2
+            flipper += flipper_degrees(position, 'hold') + flipper_degrees('hold', 'flip')
+            flips += 1
+            position = 'flip'
+    elif op == 'Y':
+        if position == 'hold':
+            commands += 1
+            flipper += flipper_degrees(position, 'spin', 'counterclockwise')
+            position = 'spin'
+        commands += 1
+        rotater += 180 if turns == 2 else 90
+    else:
+        commands += 2
+        flipper += flipper_degrees(position, 'hold')
+        rotater += 180 if turns == 2 else 90
+        position = 'hold'
+    return (commands, flipper, rotater, flips), position
+
+
+class TimingModel:
+    # speeds in motor degrees per second, overhead is the time every motor command takes on top. the
+    # defaults are estimates, python3 robot_timing.py --fit replaces them with measured ones
+    def __init__(self, flipper_speed = 520, rotater_speed = 230, overhead = 0.12, flip_wait = 0.5):
+        if not all(isinstance(f, (int, float)) and 0 < f < math.inf for f in (flipper_speed, rotater_speed, overhead, flip_wait)):
+            raise ValueError('timing factors must be positive numbers, got %r' % ((flipper_speed, rotater_speed, overhead, flip_wait),))
+        self.flipper_speed = flipper_speed
+        self.rotater_speed = rotater_speed
+        self.overhead = overhead
+        self.flip_wait = flip_wait
+        # table[position][primitive] = (seconds, flipper position afterwards)
+        self.table = {position: {p: self._simulate(position, p) for p in PRIMITIVES} for position in FLIPPER_POSITIONS}
+
+    @classmethod
+    def load(cls, path = TIMING_FILE):
+        # the calibrated model when path holds a valid one, otherwise the defaults
+        try:
+            with open(path) as f:
+                return cls(**json.load(f))
+        except FileNotFoundError:
+            return cls()
+        except (ValueError, TypeError, KeyError) as e:
+            print("Ignoring %s, using the default timing model: %s" % (path, e))
+            return cls()
+
+    def save(self, path = TIMING_FILE):
+        # written next to path and moved over it, an interrupted save leaves the old model in place
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'flipper_speed': self.flipper_speed, 'rotater_speed': self.rotater_speed,
+                       'overhead': self.overhead, 'flip_wait': self.flip_wait}, f)
+        os.replace(path + '.tmp', path)
+
+    def flipper_seconds(self, start, target, direction = None):
+        return self.overhead + flipper_degrees(start, target, direction) / self.flipper_speed
+
+    def rotater_seconds(self, degrees):
+        return self.overhead + abs(degrees) / self.rotater_speed
+
+    def factors(self):
+        # seconds per motor command, flipper degree, rotater degree and flip, see primitive_work
+        return (self.overhead, 1 / self.flipper_speed, 1 / self.rotater_speed, self.flip_wait)
+
+    def _simulate(self, position, primitive):
+        work, position = primitive_work(position, primitive)
+        return sum(w * f for w, f in zip(work, self.factors())), position
+
+    def seconds(self, plan, start = SOLVE_START):
+        # predicted run time of a primitive plan (a list or a space separated string)
+        if isinstance(plan, str):
+            plan = plan.split()
+        table = self.table
+        position = start
+        total = 0
+        for p in plan:
+            seconds, position = table[position][p]
+            total += seconds
+        return total
+
+    def position_after(self, plan, start = SOLVE_START):
+        # where the flipper is left by plan
+        position = start
+        for p in plan:
+            position = self.table[position][p][1]
+        return position
+
+    def estimate(self, moves, start = SOLVE_START, plan = False):
+        # predicted run time of a kociemba solution run move by move, or with plan of a compiled plan.
+        # a solution of D moves only reads like a plan, so the caller has to say which it is
+        if isinstance(moves, str):
+            moves = moves.split()
+        if not plan:
+            # the hub puts the cube back home before it runs face moves
+            moves = RESTORE + expand_solution(' '.join(moves))
+        return self.seconds(moves, start)
+
+    def cost(self, primitive):
+        # position independent cost for MoveCompiler, assuming the flipper was left by a flip
+        return self.table['flip'][primitive][0]
+
+
+def plan_solution(solution, compiler = None, orientation = SCANNED):
+    # the primitive plan the host sends for solution
+    compiler = compiler if compiler is not None else default_compiler()
+    return peephole(compiler.compile(solution, orientation))
+
+
+def robot_seconds(solution, model = None, compiler = None, orientation = SCANNED, position = SOLVE_START):
+    # estimated time the robot takes to run solution once compiled, starting in orientation with the
+    # flipper at position
+    model = model if model is not None else default_model()
+    return model.seconds(plan_solution(solution, compiler, orientation), position)
+
+
+def fastest(solutions, model = None, compiler = None, orientation = SCANNED, position = SOLVE_START):
+    # (estimated seconds, solution) of the solution the robot runs quickest once compiled, starting in
+    # orientation with the flipper at position
+    return min((robot_seconds(s, model, compiler, orientation, position), s) for s in solutions)
+
+
+def record_times(runs, path = TIMES_FILE):
+    # appends the primitive times the hub sent, runs are [flipper degrees, [[primitive byte, milliseconds], ...]]
+    # for every plan it ran
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        for degrees, times in runs:
+            start = min(FLIPPER_POSITIONS, key=lambda p: min((FLIPPER_POSITIONS[p] - degrees) % 360, (degrees - FLIPPER_POSITIONS[p]) % 360))
+            f.write(json.dumps([start, [[decode_plan(bytes([code]))[0], ms / 1000] for code, ms in times]]) + '\n')
+
+
+def load_times(path = TIMES_FILE):
+    # [(flipper position, primitive, seconds)] of every recorded primitive
+    samples = []
+    with open(path) as f:
+        for line in f:
+            position, times = json.loads(line)
+            for primitive, seconds in times:
+                samples.append((position, primitive, seconds))
+                position = primitive_work(position, primitive)[1]
+    return samples
+
+
+def _solve(a, b):
+    # x with a x = b by gaussian elimination, raises ValueError when a is singular
+    n = len(b)
+    rows = [list(row) + [v] for row, v in zip(a, b)]
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda r: abs(rows[r][i]))
+        if abs(rows[pivot][i]) < 1e-12:
+            raise ValueError('the recorded primitives do not tell the timing factors apart')
+        rows[i], rows[pivot] = rows[pivot], rows[i]
+        for r in range(n):
+            if r != i:
+                k = rows[r][i] / rows[i][i]
+                rows[r] = [x - k * y for x, y in zip(rows[r], rows[i])]
+    return [rows[i][n] / rows[i][i] for i in range(n)]
+
+
+def fit(samples):
+    # the TimingModel whose factors explain the sample times best in the least squares sense
+    work = [primitive_work(position, primitive)[0] for position, primitive, _ in samples]
+    a = [[sum(w[i] * w[j] for w in work) for j in range(4)] for i in range(4)]
+    b = [sum(w[i] * seconds for w, (_, _, seconds) in zip(work, samples)) for i in range(4)]
+    overhead, flipper, rotater, flip_wait = _solve(a, b)
+    if min(overhead, flipper, rotater, flip_wait) <= 0:
+        raise ValueError('the fitted timing factors are not all positive, record more runs')
+    return TimingModel(1 / flipper, 1 / rotater, overhead, flip_wait)
+
+
+def fit_error(model, samples):
+    # mean absolute error in seconds per primitive
+    return sum(abs(model.table[position][primitive][0] - seconds) for position, primitive, seconds in samples) / len(samples)
+
+
+_default = None
+
+def default_model():
+    global _default
+    if _default is None:
+        _default = TimingModel.load()
+    return _default
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Estimate how long the robot takes to run a solution or primitive plan')
+    parser.add_argument('moves', help='kociemba solution or compiled plan', nargs='?')
+    parser.add_argument('--plan', help='The moves are a compiled plan of X, Y and D primitives', action='store_true')
+    parser.add_argument('--fit', help='Fit the model to the primitive times recorded by run_spike.py and save it', action='store_true')
+    args = parser.parse_args()
+    if args.fit:
+        samples = load_times()
+        model = fit(samples)
+        print("Fitted %d primitives: flipper %.0f deg/s, rotater %.0f deg/s, overhead %.3fs, flip wait %.2fs" % (
+            len(samples), model.flipper_speed, model.rotater_speed, model.overhead, model.flip_wait))
+        print("Mean error per primitive %.3fs, %.3fs with the previous model" % (fit_error(model, samples), fit_error(default_model(), samples)))
+        model.save()
+    if args.moves:
+        print("%.1fs" % default_model().estimate(args.moves, plan=args.plan))
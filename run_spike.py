@@ -1,8 +1,24 @@
 #!/usr/bin/env python3
 
-import base64, re, os, signal, time, argparse
-import kociemba  # for custom event to solve cubes
-from spike_rpc import RPC
+import asyncio, base64, json, re, os, argparse, logging, traceback
+from cube_colors import RESCAN_LIMIT, classify, cluster, doubtful_tiles, rgbi_to_lab, tile_name
+from cube_solver import SolverPool  # for custom event to solve cubes
+from cube_model import apply_moves, check_solution
+from move_compiler import RESTORE, SCANNED, apply_plan, default_compiler, encode_plan, expand_solution, peephole, plan_moves, split_plan
+from rescan_planner import format_steps, plan_rescan
+from robot_search import tables_built
+from robot_timing import SOLVE_START, default_model, record_times
+from spike_rpc import UploadManifest, UPLOAD_WINDOW
+from spike_daemon import async_connect
+
+# seconds kept between solving the rest of a streamed plan and the robot finishing the first part
+STREAM_MARGIN = 1
+
+# scans with the cube they were solved as, for python3 bench_classifier.py -f
+SCAN_LOG = os.path.expanduser('~/.cubebot/scans.jsonl')
+
+# colour spaces the readings can be classified in
+COLOR_SPACES = {'lab': rgbi_to_lab, 'rgbi': None}
 
 # constants for the status mesage
 MOTOR_TYPES = [65, 48, 49, 75, 76, 38, 46, 47]
@@ -15,93 +31,272 @@ parser.add_argument('-p', '--port', help='Spike Hub device path or com port', de
 parser.add_argument('-f', '--filename', help='Program to run')
 parser.add_argument('-s', '--slot', help='Slot of the program to run', type=int, default=0)
 parser.add_argument('-t', '--type', help='Type of Spike application',choices=("python", "scratch"), default="python")
+parser.add_argument('-w', '--window', help='Blocks in flight during upload, 1 waits for each block', type=int, default=UPLOAD_WINDOW)
+parser.add_argument('--force-upload', help='Upload the program even if the slot already holds it', action='store_true')
+parser.add_argument('--solve-timeout', help='Seconds allowed for solving a scanned cube', type=float, default=10)
+parser.add_argument('--solve-deadline', help='Seconds spent looking for a solution the robot runs faster, 0 sends the first one found', type=float, default=0.3)
+parser.add_argument('--robot-search', help='Seconds spent searching robot primitives for a faster plan (needs numpy and python3 robot_search.py --build)', type=float, default=0)
+parser.add_argument('--stream', help='Send the first half of the plan straight away and improve the rest while the robot runs it', action=argparse.BooleanOptionalAction, default=True)
+parser.add_argument('--cluster', help='Classify the tiles by clustering the scan instead of using the calibrated colours', action='store_true')
+parser.add_argument('--space', help='Compare the readings in CIELAB or as raw RGBI', choices=COLOR_SPACES, default='rgbi')
+parser.add_argument('--rescan', help='Read up to this many low confidence tiles again before solving, 0 never rescans', type=int, default=RESCAN_LIMIT)
 parser.add_argument('-m', '--monitor', help='Monitor device status information', action=argparse.BooleanOptionalAction)
+parser.add_argument('--direct', help='Open the hub directly instead of going through spike_daemon.py', action='store_true')
 parser.add_argument('--debug', help='Enable debug', action='store_true')
-args = parser.parse_args()
-if args.debug:
-    logging.basicConfig(level=logging.DEBUG)
-
-# upload and run the program
-rpc = RPC(args.port)
-spikeFile = os.path.abspath(args.filename)
-rpc.uploadProgram(spikeFile, args.slot, args.type)
-rpc.program_execute(args.slot)
-
-# if we ctrl+C then stop the running program
-def handler(signum, frame):
-    rpc.program_terminate()
-    exit(0)
-signal.signal(signal.SIGINT, handler)
-
-show_status = args.monitor
-
-start = time.time()
-# read the output
-while (True):
-
-    # read messages from the spike
-    msg = rpc.getNextMessage()
-    # handle RPC events
-    if msg and isinstance(msg, dict):
-        # messages
-        if 'm' in msg:
-            # when a cube is scanned then create a solution and send it back
-            if msg['m'] == 'cube_scanned':
-                cube = msg['p']
-                print("Recieved scanned cube %s" % cube)
-                solution = kociemba.solve(cube)
-                print("Sending cube solution %s" % solution)
-                rpc.send_message("solve_cube", solution, False)
-
-            # handle errors
-            elif msg['m'] == 'user_program_error' or msg['m'] == 'runtime_error':
-                error = base64.b64decode(msg['p'][3]).decode('utf-8')
-                # make source file links clickable in VSCode by updating the path to be the local file
-                error = re.sub("\./projects/\d+/__init__.py", spikeFile, error)
-                print('\033[91m' + error + '\033[0m')
 
-            # program start stop messages
-            elif msg['m'] == 12:
-                if msg['p'][1]:
-                    print("Program started")
+# started in main(), the pool's worker processes import this module again under spawn
+solver = None
+
+def plan_message(plan, seq = None, last = True):
+    # solve_cube parameters for a compiled plan, streamed plans come in numbered chunks
+    message = {'plan': base64.b64encode(encode_plan(plan)).decode('ascii')}
+    if seq is not None:
+        message.update(seq=seq, last=last)
+    return message
+
+async def stream(rpc, cube, solution, plan, orientation, position):
+    # the robot runs the first half of the moves while the cube it leaves is solved again, with the
+    # time that takes to look for a faster way to finish
+    timing = default_model()
+    moves = solution.split()
+    half = len(moves) // 2
+    first, rest = split_plan(plan, half)
+    busy = timing.seconds(first, position)
+    print("Sending first %d primitives (est. %.0fs), solving the rest meanwhile" % (len(first), busy))
+    await rpc.send_message("solve_cube", plan_message(first, 0, False), False)
+    orientation = apply_plan(orientation, first)
+    position = timing.position_after(first, position)
+    # the hub waits for the remaining chunk whatever happens here, so it always goes, the original
+    # remainder unless a faster one was found
+    finish = rest
+    try:
+        solution = await solver.solve_anytime(apply_moves(cube, ' '.join(moves[:half])), busy - STREAM_MARGIN, args.solve_timeout,
+                                              free=busy - STREAM_MARGIN, orientation=orientation, position=position)
+        better = peephole(default_compiler().compile(solution, orientation))
+        if timing.seconds(better, position) < timing.seconds(rest, position):
+            print("Found a faster finish (est. %.0fs instead of %.0fs)" % (timing.seconds(better, position), timing.seconds(rest, position)))
+            finish = better
+    except asyncio.TimeoutError:
+        print("No solution for the rest of the plan within %ss, keeping the original" % args.solve_timeout)
+    except Exception as e:
+        # a ValueError here is a remainder that failed check_solution
+        print('\033[91m' + "Improving the rest of the plan failed: %r" % e + '\033[0m')
+    finally:
+        print("Sending remaining %d primitives %s" % (len(finish), ' '.join(finish)))
+        await rpc.send_message("solve_cube", plan_message(finish, 1, True), False)
+
+def report_solve_error(task):
+    # solve runs as a task nobody awaits, so its errors would go unseen
+    if not task.cancelled() and task.exception() is not None:
+        error = ''.join(traceback.format_exception(task.exception()))
+        print('\033[91m' + "Solving failed: " + error + '\033[0m')
+
+def scanned_cube(scan):
+    # (cube string, tile confidences) from a cube_scanned message, either the hub's string or a dict
+    # with the string the hub classified, the raw RGBI readings and its colour references to classify
+    # together. a plain string has no confidences
+    if not isinstance(scan, dict):
+        return scan, None
+    references = scan.get('ref')
+    if args.cluster or not references or None in references:
+        # no calibration needed, the colours come from the scan itself
+        cube, confidence, references = cluster(scan['rgbi'], space=COLOR_SPACES[args.space])
+    else:
+        cube, confidence = classify(scan['rgbi'], references, COLOR_SPACES[args.space])
+    # an uncalibrated hub sends '?' for every tile
+    if cube != scan['cube'] and '?' not in scan['cube']:
+        changed = [tile_name(i) for i in range(54) if cube[i] != scan['cube'][i]]
+        print("Corrected %d tiles of the scan (%s)" % (len(changed), ' '.join(changed)))
+    doubtful = sorted((confidence[i], tile_name(i)) for i in doubtful_tiles(confidence))
+    if doubtful:
+        print("Low confidence tiles: %s" % ' '.join("%s %.2f" % (name, c) for c, name in doubtful))
+    return cube, confidence
+
+def record_scan(scan, cube):
+    # the readings are only worth keeping with the references they were taken against
+    if not isinstance(scan, dict):
+        return
+    os.makedirs(os.path.dirname(SCAN_LOG), exist_ok=True)
+    with open(SCAN_LOG, 'a') as file:
+        file.write(json.dumps(dict(scan, solved=cube)) + '\n')
+
+async def rescan(rpc, tiles):
+    # asks the hub to read tiles again, returns where that leaves the cube (orientation, flipper position)
+    seconds, steps, orientation, position = plan_rescan(tiles)
+    print("Rescanning %d tiles: %s (est. %.0fs)" % (len(tiles), format_steps(steps), seconds))
+    # primitives go as the byte codes runPlan takes
+    steps = [encode_plan([step])[0] if isinstance(step, str) and step not in '+-' else step for step in steps]
+    await rpc.send_message("rescan_tiles", steps, False)
+    return orientation, position
+
+async def solve(rpc, cube, orientation = SCANNED, position = SOLVE_START):
+    # runs next to the monitor loop so hub messages keep being read while solving
+    try:
+        solution = await solver.solve_anytime(cube, args.solve_deadline, args.solve_timeout, orientation=orientation, position=position)
+    except asyncio.TimeoutError:
+        print('\033[91m' + "No solution found within %ss" % args.solve_timeout + '\033[0m')
+        return
+    except ValueError as e:
+        print('\033[91m' + "Cannot solve cube %s: %s" % (cube, e) + '\033[0m')
+        return
+    print("Found cube solution %s (%s)" % (solution, solver.solver.cache.stats()))
+    # send the robot primitives instead of face moves so the hub does not reorient after every move,
+    # they start from where the scan (or rescan) left the cube while face moves need it put back home first
+    timing = default_model()
+    plan = peephole(default_compiler().compile(solution, orientation))
+    naive = RESTORE + expand_solution(solution)
+    tidied = peephole(naive)
+    # a robot search plan has no solution to split for streaming
+    searched = False
+    # robot search plans start where scanCube leaves the cube
+    if args.robot_search and orientation == SCANNED and position == SOLVE_START:
+        seconds, primitives = await solver.search_robot(cube, args.robot_search, timing.seconds(plan), args.robot_search + args.solve_timeout)
+        if primitives:
+            try:
+                # the plan is checked like a kociemba solution, a wrong one costs minutes of robot moves
+                check_solution(cube, plan_moves(primitives, orientation))
+                print("Robot search found a faster plan (est. %.0fs instead of %.0fs)" % (seconds, timing.seconds(plan)))
+                plan = primitives
+                searched = True
+            except ValueError as e:
+                print('\033[91m' + "Ignoring the robot search plan: %s" % e + '\033[0m')
+    print("Robot plan %s (%d primitives, est. %.0fs; face moves %.0fs, peephole alone removes %d primitives and %.0fs)" % (
+        ' '.join(plan), len(plan), timing.seconds(plan, position), timing.seconds(naive), len(naive) - len(tidied), timing.seconds(naive) - timing.seconds(tidied)))
+    if args.stream and not searched and len(solution.split()) > 1:
+        await stream(rpc, cube, solution, plan, orientation, position)
+    else:
+        await rpc.send_message("solve_cube", plan_message(plan), False)
+
+async def monitor(rpc):
+    solving = None
+    scan = None
+    rescanned = None
+    # read the output
+    async for msg in rpc.events():
+        # handle RPC events
+        if msg and isinstance(msg, dict):
+            # messages
+            if 'm' in msg:
+                # when a cube is scanned then create a solution and send it back
+                if msg['m'] == 'cube_scanned':
+                    scan = msg['p']
+                    cube, confidence = scanned_cube(scan)
+                    print("Recieved scanned cube %s" % cube)
+                    tiles = doubtful_tiles(confidence) if confidence else []
+                    if tiles and len(tiles) <= args.rescan:
+                        # read just the doubtful tiles again instead of solving a cube that may be wrong
+                        rescanned = await rescan(rpc, tiles)
+                    else:
+                        record_scan(scan, cube)
+                        solving = asyncio.create_task(solve(rpc, cube))
+                        solving.add_done_callback(report_solve_error)
+
+                # the doubtful tiles read again replace their first readings
+                elif msg['m'] == 'tiles_rescanned' and rescanned:
+                    for tile, rgbi in msg['p']:
+                        scan['rgbi'][tile] = rgbi
+                    cube, confidence = scanned_cube(scan)
+                    print("Rescanned cube %s" % cube)
+                    record_scan(scan, cube)
+                    solving = asyncio.create_task(solve(rpc, cube, *rescanned))
+                    solving.add_done_callback(report_solve_error)
+                    rescanned = None
+
+                # the rest of a streamed plan did not reach the hub in time
+                elif msg['m'] == 'plan_aborted':
+                    print('\033[91m' + "The hub gave up waiting for chunk %d of the plan" % msg['p'] + '\033[0m')
+
+                # how long the hub took for every primitive, for python3 robot_timing.py --fit
+                elif msg['m'] == 'primitives_timed':
+                    record_times(msg['p'])
+                    print("Recorded the times of %d primitives" % sum(len(times) for _, times in msg['p']))
+
+                # handle errors
+                elif msg['m'] == 'user_program_error' or msg['m'] == 'runtime_error':
+                    error = base64.b64decode(msg['p'][3]).decode('utf-8')
+                    # make source file links clickable in VSCode by updating the path to be the local file
+                    error = re.sub("\./projects/\d+/__init__.py", spikeFile, error)
+                    print('\033[91m' + error + '\033[0m')
+
+                # program start stop messages
+                elif msg['m'] == 12:
+                    if msg['p'][1]:
+                        print("Program started")
+                    else:
+                        print("Program ended")
+                        if solving:
+                            solving.cancel()
+                        break # end monitoring
+
+                # handle device status messages
+                elif msg['m'] == 0:
+                    if show_status:
+                        status = msg['p']
+                        statusOut = ""
+                        for i in range(6):
+                            if status[i][0] in MOTOR_TYPES:
+                                statusOut += "{}:motor({:>4},{:>4}) ".format(PORTS_NAMES[i], status[i][1][1], status[i][1][2])
+                            elif status[i][0] == SPIKE_COLOR:
+                                statusOut += "{}:color({:>3},{:>3},{:>3}) ".format(PORTS_NAMES[i], status[i][1][2], status[i][1][3], status[i][1][4])
+                        if statusOut:
+                            print(statusOut)
+
+                # battery  [8.294, 100, True]
+                elif msg['m'] == 2:
+                    if show_status:
+                        print("Battery: {}%".format(msg['p'][1]))
+
+                # print any unknown messages
                 else:
-                    print("Program ended")
-                    break # end monitoring
-            
-            # handle device status messages
-            elif msg['m'] == 0:
-                if show_status:
-                    status = msg['p']
-                    statusOut = ""
-                    for i in range(6):
-                        if status[i][0] in MOTOR_TYPES:
-                            statusOut += "{}:motor({:>4},{:>4}) ".format(PORTS_NAMES[i], status[i][1][1], status[i][1][2])
-                        elif status[i][0] == SPIKE_COLOR:
-                            statusOut += "{}:color({:>3},{:>3},{:>3}) ".format(PORTS_NAMES[i], status[i][1][2], status[i][1][3], status[i][1][4])
-                    if statusOut:
-                        print(statusOut)
-
-            # battery  [8.294, 100, True]
-            elif msg['m'] == 2:
-                if show_status:
-                    print("Battery: {}%".format(msg['p'][1]))
-
-            # print any unknown messages
-            else:
+                    print(repr(msg))
+
+            # system errors
+            elif 'e' in msg:
+                error = base64.b64decode(msg['e']).decode('utf-8')
+                print('\033[91m' + error + '\033[0m')
+
+            # print any unknown json object
+            elif msg:
                 print(repr(msg))
-        
-        # system errors
-        elif 'e' in msg:
-            error = base64.b64decode(msg['e']).decode('utf-8')
-            print('\033[91m' + error + '\033[0m')
 
-        # print unknown json object
+        # print any strings output via 'print' in the program
         elif msg:
-            print(repr(msg))
-
-    # print any strings output via 'print' in the program
-    elif msg:
-        if msg == "exit":
-            rpc.program_terminate()
-            exit(0)
-        print(msg)
+            if msg == "exit":
+                await rpc.program_terminate()
+                return
+            print(msg)
+
+async def main():
+    global solver
+    # load the solver tables while the program uploads and the robot initializes and scans
+    solver = SolverPool()
+    solver.warm_up()
+    async with async_connect(args.port, args.direct) as rpc:
+        # upload and run the program, unchanged programs are only started
+        manifest = None if args.force_upload else UploadManifest()
+        await rpc.uploadProgram(spikeFile, args.slot, args.type, window=args.window, manifest=manifest)
+        await rpc.program_execute(args.slot)
+        try:
+            await monitor(rpc)
+        except asyncio.CancelledError:
+            # if we ctrl+C then stop the running program
+            await rpc.program_terminate()
+            raise
+        finally:
+            solver.shutdown()
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    show_status = args.monitor
+    if args.robot_search and not tables_built():
+        print("No robot search tables for the current timing model, build them with python3 robot_search.py --build")
+        args.robot_search = 0
+    spikeFile = os.path.abspath(args.filename)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        exit(0)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+
+# long running process that keeps the serial session to the hub open
+# spike_rpc.py and run_spike.py forward their calls to it over a unix socket and fall back to
+# opening the hub directly when no daemon is running
+#
+# python3 spike_daemon.py -t /dev/ttyACM0
+
+import argparse, asyncio, inspect, json, logging, os, socket
+
+SOCKET_DIR = os.path.expanduser('~/.cubebot')
+
+# calls a client may forward to the hub connection
+DAEMON_CALLS = {
+    'send_message', 'program_execute', 'program_terminate', 'get_storage_information', 'start_write_program',
+    'write_package', 'move_project', 'remove_project', 'display_set_pixel', 'display_clear', 'display_image',
+    'display_image_for', 'display_text', 'get_firmware_info', 'uploadProgram',
+}
+
+
+# status messages kept waiting for a client before new ones are dropped
+SUBSCRIBER_EVENTS = 1024
+
+
+def daemon_socket(tty):
+    return os.path.join(SOCKET_DIR, 'spike-%s.sock' % os.path.basename(tty))
+
+
+def daemon_running(tty):
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(daemon_socket(tty))
+            return True
+        except OSError:
+            return False
+
+
+def encode_request(name, args, kwargs):
+    # upload manifests are recreated from their path inside the daemon
+    manifest = kwargs.get('manifest')
+    if manifest is not None:
+        kwargs['manifest'] = manifest.path
+    if name == 'uploadProgram':
+        args = (os.path.abspath(args[0]),) + tuple(args[1:])
+    return json.dumps({'call': name, 'args': args, 'kwargs': kwargs}).encode('utf-8') + b'\n'
+
+
+def decode_reply(line):
+    if not line:
+        raise ConnectionError('hub daemon closed the connection')
+    reply = json.loads(line)
+    if 'e' in reply:
+        raise ConnectionError(reply['e'])
+    return reply.get('r')
+
+
+class HubClient:
+    # blocking client used by the spike_rpc.py command line, every RPC method is forwarded
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rwb')
+
+    def call(self, name, *args, **kwargs):
+        self.file.write(encode_request(name, args, kwargs))
+        self.file.flush()
+        return decode_reply(self.file.readline())
+
+    def __getattr__(self, name):
+        if name not in DAEMON_CALLS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class AsyncHubClient:
+    # asyncio client with the same interface as AsyncRPC
+    def __init__(self, path):
+        self.path = path
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.lock = asyncio.Lock()
+        # subscribe straight away so nothing sent while the program starts is missed
+        self.event_reader, self.event_writer = await asyncio.open_unix_connection(self.path)
+        self.event_writer.write(encode_request('events', (), {}))
+
+    def close(self):
+        self.writer.close()
+        self.event_writer.close()
+
+    async def call(self, name, *args, **kwargs):
+        async with self.lock:
+            self.writer.write(encode_request(name, args, kwargs))
+            return decode_reply(await self.reader.readline())
+
+    def __getattr__(self, name):
+        if name not in DAEMON_CALLS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    async def events(self):
+        while True:
+            line = await self.event_reader.readline()
+            if not line:
+                return
+            yield json.loads(line)
+
+
+def connect(tty, direct = False):
+    # RPC like object for tty, going through the daemon when one is running
+    if not direct and daemon_running(tty):
+        return HubClient(daemon_socket(tty))
+    from spike_rpc import RPC
+    return RPC(tty)
+
+
+def async_connect(tty, direct = False):
+    # unopened AsyncRPC like object for tty, use with 'async with'
+    if not direct and daemon_running(tty):
+        return AsyncHubClient(daemon_socket(tty))
+    from spike_rpc import AsyncRPC
+    return AsyncRPC(tty)
+
+
+async def serve(tty, path):
+    from spike_rpc import AsyncRPC, UploadManifest, offer_event
+    subscribers = set()
+
+    async def call(rpc, request):
+        name = request.get('call')
+        if name not in DAEMON_CALLS:
+            raise ConnectionError('unknown call %s' % name)
+        kwargs = request.get('kwargs', {})
+        if kwargs.get('manifest'):
+            kwargs['manifest'] = UploadManifest(kwargs['manifest'])
+        result = getattr(rpc, name)(*request.get('args', []), **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def stream_events(writer):
+        queue = asyncio.Queue()
+        subscribers.add(queue)
+        try:
+            while True:
+                writer.write(json.dumps(await queue.get()).encode('utf-8') + b'\n')
+                await writer.drain()
+        finally:
+            subscribers.discard(queue)
+
+    async def handle(rpc, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                if isinstance(request, dict) and request.get('call') == 'events':
+                    await stream_events(writer)
+                    break
+                try:
+                    if not isinstance(request, dict):
+                        raise ValueError('requests are JSON objects')
+                    reply = {'r': await call(rpc, request)}
+                except Exception as e:
+                    reply = {'e': str(e)}
+                writer.write(json.dumps(reply).encode('utf-8') + b'\n')
+                await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            logging.debug('client dropped: %s' % e)
+        finally:
+            writer.close()
+
+    async with AsyncRPC(tty) as rpc:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(lambda r, w: handle(rpc, r, w), path)
+        print("Serving %s on %s" % (tty, path))
+        try:
+            # hand every hub event to the subscribed clients until the hub goes away
+            async for msg in rpc.events():
+                logging.debug('event: %s' % (msg,))
+                # a slow client only misses status messages
+                for queue in list(subscribers):
+                    offer_event(queue, msg, SUBSCRIBER_EVENTS)
+        finally:
+            server.close()
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Keep a Spike Hub connection open for spike_rpc.py and run_spike.py')
+    parser.add_argument('-t', '--tty', help='Spike Hub device path', default='/dev/ttyACM0')
+    parser.add_argument('--debug', help='Enable debug', action='store_true')
+    args = parser.parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+    try:
+        asyncio.run(serve(args.tty, daemon_socket(args.tty)))
+    except KeyboardInterrupt:
+        pass
@@ -10,87 +10,155 @@ import base64
 import os
 # import sys
 import argparse
+import asyncio
+import collections
+import concurrent.futures
 from tqdm import tqdm
 import time
 import json
+import hashlib
 import random
 import string
 import logging
+import queue
+import threading
 from datetime import datetime
 
 letters = string.ascii_letters + string.digits + '_'
 def random_id(len = 4):
   return ''.join(random.choice(letters) for _ in range(4))
 
-class RPC:
-  def __init__(self, tty = '/dev/ttyACM0'):
-    self.ser = serial.Serial(tty, 115200)
-    self.recv_buf = bytearray()
-
-  def recv_message(self, timeout = 1):
-    start_time = time.time()
-    elapsed = 0
-    while True:
-      pos = self.recv_buf.find(b'\x0d')
-      if pos >= 0:
-        result = self.recv_buf[:pos]
-        self.recv_buf = self.recv_buf[pos+1:]
-        try:
-          return json.loads(result.decode('utf-8'))
-        except json.JSONDecodeError:
-          logging.debug("Cannot parse JSON: %s" % result)
-      c = self.ser.in_waiting
-      if c == 0 and elapsed >= timeout:
-        break
-      self.ser.timeout = 1 - timeout
-      self.recv_buf = self.recv_buf + self.ser.read(c if c else 1)
-      elapsed = time.time() - start_time
-    return None
-
-  def send_message(self, name, params = {}, expect_respose = True):
-    while True:
-      if not self.recv_message(timeout=0):
-        break
-    id = random_id()
-    msg = {'m':name, 'p': params, 'i': id}
-    msg_string = json.dumps(msg)
-    logging.debug('sending: %s' % msg_string)
-    self.ser.write(msg_string.encode('utf-8'))
-    self.ser.write(b'\x0D')
-    if (expect_respose):
-      return self.recv_response(id)
-
-  def recv_response(self, id):
-    while True:
-      m = self.recv_message()
-      if m and 'i' in m and m['i'] == id:
-        logging.debug('response: %s' % m)
-        if 'e' in m:
-          error = json.loads(base64.b64decode(m['e']).decode('utf-8'))
-          raise ConnectionError(error)
-        return m['r']
-      logging.debug('while waiting for response: %s' % m)
-
-  def getNextMessage(self, timeout = 1):
-    start_time = time.time()
-    elapsed = 0
-    while True:
-      pos = self.recv_buf.find(b'\x0d')
-      if pos >= 0:
-        result = self.recv_buf[:pos]
-        self.recv_buf = self.recv_buf[pos+1:]
-        try:
-          result = result.decode('utf-8')
-          return json.loads(result)
-        except json.JSONDecodeError:
-          return result
-      c = self.ser.in_waiting
-      if c == 0 and elapsed >= timeout:
-        break
-      self.ser.timeout = 1 - timeout
-      self.recv_buf = self.recv_buf + self.ser.read(c if c else 1)
-      elapsed = time.time() - start_time
-    return None
+class FrameDecoder:
+  """
+  Splits the byte stream from the hub into \\r terminated frames.
+
+  Frames are cut from the front of one bytearray, which CPython does without moving the
+  bytes that follow, and a partial frame is only searched for the delimiter once.
+  """
+  def __init__(self, delimiter = b'\x0d'):
+    self.buf = bytearray()
+    self.delimiter = delimiter
+    self.scanned = 0  # bytes already known not to contain the delimiter
+
+  def __len__(self):
+    return len(self.buf)
+
+  def feed(self, data):
+    self.buf += data
+
+  def next_frame(self):
+    pos = self.buf.find(self.delimiter, self.scanned)
+    if pos < 0:
+      self.scanned = len(self.buf)
+      return None
+    frame = bytes(self.buf[:pos])
+    del self.buf[:pos + 1]
+    self.scanned = 0
+    return frame
+
+  def frames(self):
+    frame = self.next_frame()
+    while frame is not None:
+      yield frame
+      frame = self.next_frame()
+
+
+def parse_frame(frame):
+  # hub frames are JSON messages, anything else is text printed by the running program
+  result = frame.decode('utf-8', 'replace')
+  try:
+    return json.loads(result)
+  except json.JSONDecodeError:
+    return result
+
+def is_response(msg):
+  return isinstance(msg, dict) and 'i' in msg and 'm' not in msg
+
+# status (m 0) and battery (m 2) messages the hub sends several times a second. they are the only
+# events dropped when the consumer falls behind, the program's own events and output never are
+TELEMETRY_MESSAGES = (0, 2)
+
+def is_telemetry(msg):
+  return isinstance(msg, dict) and msg.get('m') in TELEMETRY_MESSAGES
+
+def offer_event(events, msg, limit):
+  # puts msg on an unbounded queue unless it is telemetry and limit events are already waiting
+  if is_telemetry(msg) and events.qsize() >= limit:
+    return False
+  events.put_nowait(msg)
+  return True
+
+def response_result(m):
+  if 'e' in m:
+    error = json.loads(base64.b64decode(m['e']).decode('utf-8'))
+    raise ConnectionError(error)
+  return m.get('r')
+
+
+# number of write_package blocks kept in flight while uploading, 1 is stop-and-wait
+UPLOAD_WINDOW = 4
+# seconds the hub gets to answer the blocks still in flight once one failed, the rest are given up
+UPLOAD_DRAIN_TIMEOUT = 5
+
+def encode_blocks(data, blocksize):
+  # base64 encode every upload block before the transfer starts
+  blocks = []
+  for i in range(0, len(data), blocksize):
+    block = data[i:i + blocksize]
+    blocks.append((len(block), str(base64.b64encode(block), 'utf-8')))
+  return blocks
+
+def wait_block(in_flight):
+  size, future = in_flight
+  future.result()
+  return size
+
+def upload_rate(size, elapsed):
+  rate = size / elapsed if elapsed > 0 else 0
+  print("Uploaded %d bytes in %.2fs (%.0f B/s)" % (size, elapsed, rate))
+  return rate
+
+
+# local record of uploaded programs
+UPLOAD_MANIFEST = os.path.expanduser('~/.cubebot/uploads.json')
+
+class UploadManifest:
+  # maps slot to the hash, size and hub modified timestamp of the program uploaded there
+  # so a program that has not changed is not uploaded again
+  def __init__(self, path = UPLOAD_MANIFEST):
+    self.path = path
+    try:
+      with open(path) as f:
+        self.slots = json.load(f)
+    except (OSError, ValueError):
+      self.slots = {}
+
+  def is_current(self, slot, data, type, slots):
+    # slots is the slot metadata from get_storage_information()
+    entry = self.slots.get(str(slot))
+    hub_slot = slots.get(str(slot))
+    if not entry or not hub_slot:
+      return False
+    # the hub does not always report a slot's size, it only counts when it does
+    size = hub_slot.get('size')
+    return (entry['hash'] == hashlib.sha256(data).hexdigest() and entry['type'] == type
+      and (size is None or size == len(data))
+      and entry['modified'] == hub_slot.get('modified'))
+
+  def record(self, slot, data, type, slots):
+    hub_slot = slots.get(str(slot))
+    if not hub_slot:
+      self.slots.pop(str(slot), None)
+    else:
+      self.slots[str(slot)] = {'hash': hashlib.sha256(data).hexdigest(), 'type': type, 'size': len(data), 'modified': hub_slot.get('modified')}
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    with open(self.path, 'w') as f:
+      json.dump(self.slots, f, indent=2)
+
+
+class HubMethods:
+  # wrappers for the hub RPC calls, shared by RPC and AsyncRPC
+  # with AsyncRPC send_message is a coroutine, so every wrapper returns an awaitable
 
 # Program Methods
   def program_execute(self, n):
@@ -131,26 +199,397 @@ class RPC:
   def display_text(self, text):
     return self.send_message('scratch.display_text', {'text':text})
 
-  def uploadProgram(self, file, to_slot, type = 'python'):
-    with open(file, "rb") as f:
-      size = os.path.getsize(file)
-      name = file
-      now = int(time.time() * 1000)
-      start = self.start_write_program(name, size, to_slot, now, now, type)
-      bs = start['blocksize']
-      id = start['transferid']
-      with tqdm(total=size, unit='B', unit_scale=True) as pbar:
-        b = f.read(bs)
-        while b:
-          self.write_package(b, id)
-          pbar.update(len(b))
-          b = f.read(bs)
-
 # Hub Methods
   def get_firmware_info(self):
     return self.send_message('get_hub_info')
 
 
+class RPC(HubMethods):
+  def __init__(self, tty = '/dev/ttyACM0', max_events = 1024):
+    self.ser = serial.Serial(tty, 115200, timeout = 0.5)
+    self.decoder = FrameDecoder()
+    # responses are delivered to the future registered for their id, everything else is an event
+    self.pending = {}
+    self.pending_lock = threading.Lock()
+    self.write_lock = threading.Lock()
+    self.events = queue.Queue()
+    self.max_events = max_events
+    self.dropped_events = 0
+    self.running = True
+    self.reader = threading.Thread(target=self._reader_loop, name='spike-rpc-reader', daemon=True)
+    self.reader.start()
+
+  def _reader_loop(self):
+    # the reader thread owns the receiving side of the serial port
+    try:
+      while self.running:
+        data = self.ser.read(self.ser.in_waiting or 1)
+        if not data:
+          continue
+        self.decoder.feed(data)
+        for frame in self.decoder.frames():
+          self._dispatch(parse_frame(frame))
+    except Exception as e:
+      if self.running:
+        logging.error('serial reader stopped: %s' % e)
+        self._fail_pending(ConnectionError(e))
+    finally:
+      self.running = False
+
+  def _dispatch(self, msg):
+    if is_response(msg):
+      with self.pending_lock:
+        future = self.pending.pop(msg['i'], None)
+      if future and not future.done():
+        logging.debug('response: %s' % msg)
+        try:
+          future.set_result(response_result(msg))
+        except ConnectionError as e:
+          future.set_exception(e)
+        return
+    self._put_event(msg)
+
+  def _put_event(self, msg):
+    if not offer_event(self.events, msg, self.max_events):
+      self.dropped_events += 1
+      logging.debug('event queue full, dropped status message')
+
+  def _fail_pending(self, error):
+    with self.pending_lock:
+      futures = list(self.pending.values())
+      self.pending.clear()
+    for future in futures:
+      if not future.done():
+        future.set_exception(error)
+
+  def _give_up(self, futures):
+    # requests that are not waited for any more, a late answer is treated like an event
+    with self.pending_lock:
+      for id in [id for id, future in self.pending.items() if future in futures]:
+        del self.pending[id]
+    for future in futures:
+      future.cancel()
+
+  def close(self):
+    self.running = False
+    self.reader.join()
+    self.ser.close()
+    self._fail_pending(ConnectionError('connection closed'))
+
+  def recv_message(self, timeout = 1):
+    # next JSON event, text output is skipped
+    deadline = time.time() + timeout
+    while True:
+      m = self.getNextMessage(max(0, deadline - time.time()))
+      if m is None or isinstance(m, dict):
+        return m
+      logging.debug("Cannot parse JSON: %s" % m)
+
+  def send_request(self, name, params = {}):
+    # sends a message and returns a Future for its response so several requests can be in flight
+    future = concurrent.futures.Future()
+    with self.pending_lock:
+      if not self.running:
+        raise ConnectionError('connection closed')
+      id = random_id()
+      while id in self.pending:
+        id = random_id()
+      self.pending[id] = future
+    self._write(name, params, id)
+    return future
+
+  def send_message(self, name, params = {}, expect_respose = True, timeout = None):
+    if (expect_respose):
+      future = self.send_request(name, params)
+      try:
+        return future.result(timeout)
+      except concurrent.futures.TimeoutError:
+        self._give_up([future])
+        raise
+    self._write(name, params, random_id())
+
+  def _write(self, name, params, id):
+    msg = {'m':name, 'p': params, 'i': id}
+    msg_string = json.dumps(msg)
+    logging.debug('sending: %s' % msg_string)
+    with self.write_lock:
+      self.ser.write(msg_string.encode('utf-8') + b'\x0D')
+
+  def getNextMessage(self, timeout = 1):
+    try:
+      if timeout <= 0:
+        return self.events.get_nowait()
+      return self.events.get(timeout = timeout)
+    except queue.Empty:
+      return None
+
+  def uploadProgram(self, file, to_slot, type = 'python', name = None, window = UPLOAD_WINDOW, manifest = None):
+    # with a manifest the upload is skipped (returning None) when the slot already holds this program
+    with open(file, "rb") as f:
+      data = f.read()
+    if manifest and manifest.is_current(to_slot, data, type, self.get_storage_information()['slots']):
+      print("Program in slot %d is unchanged, skipping upload" % to_slot)
+      return None
+    name = name if name else file
+    start_time = time.time()
+    try:
+      self._upload(data, name, to_slot, type, window)
+    except ConnectionError as e:
+      if window <= 1:
+        raise
+      logging.warning('hub rejected pipelined upload (%s), retrying stop-and-wait' % e)
+      self._upload(data, name, to_slot, type, 1)
+    rate = upload_rate(len(data), time.time() - start_time)
+    if manifest:
+      manifest.record(to_slot, data, type, self.get_storage_information()['slots'])
+    return rate
+
+  def _upload(self, data, name, to_slot, type, window):
+    now = int(time.time() * 1000)
+    start = self.start_write_program(name, len(data), to_slot, now, now, type)
+    id = start['transferid']
+    in_flight = collections.deque()
+    with tqdm(total=len(data), unit='B', unit_scale=True) as pbar:
+      try:
+        for size, block in encode_blocks(data, start['blocksize']):
+          # keep up to window write_package requests outstanding
+          if len(in_flight) >= window:
+            pbar.update(wait_block(in_flight.popleft()))
+          in_flight.append((size, self.send_request('write_package', {'data': block, 'transferid': id})))
+        while in_flight:
+          pbar.update(wait_block(in_flight.popleft()))
+      finally:
+        # let the hub answer what is still outstanding before the caller retries, a hub that dropped
+        # the blocks after a rejected one would otherwise be waited for forever
+        futures = [future for size, future in in_flight]
+        if futures:
+          concurrent.futures.wait(futures, UPLOAD_DRAIN_TIMEOUT)
+          self._give_up(futures)
+
+
+class AsyncRPC(HubMethods):
+  """
+  asyncio version of RPC. Reads are driven by the event loop watching the serial port,
+  so hub traffic is handled without a polling thread.
+
+    async with AsyncRPC(tty) as rpc:
+      await rpc.program_execute(0)
+      async for msg in rpc.events():
+        ...
+  """
+  def __init__(self, tty = '/dev/ttyACM0', max_events = 1024):
+    self.tty = tty
+    self.ser = None
+    self.decoder = FrameDecoder()
+    self.pending = {}
+    self.event_queue = asyncio.Queue()
+    self.max_events = max_events
+    self.dropped_events = 0
+    self.reader = None
+    self.running = False
+    # bytes not taken by the port yet, flushed whenever the event loop sees it writable
+    self.write_buffer = bytearray()
+    self.writing = False
+    self.writer = None
+
+  async def __aenter__(self):
+    await self.open()
+    return self
+
+  async def __aexit__(self, *exc):
+    self.close()
+
+  async def open(self):
+    self.loop = asyncio.get_running_loop()
+    self.ser = serial.Serial(self.tty, 115200, timeout = 0)
+    self.running = True
+    try:
+      self.loop.add_reader(self.ser.fileno(), self._on_readable)
+    except (AttributeError, OSError, ValueError, NotImplementedError):
+      # no selectable file descriptor (e.g. windows com ports), hand blocking reads to a thread
+      self.ser.timeout = 0.5
+      self.reader = threading.Thread(target=self._reader_loop, name='spike-async-reader', daemon=True)
+      self.reader.start()
+      # and blocking writes to another one, a single thread keeps them in order
+      self.writer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='spike-async-writer')
+
+  def close(self):
+    if not self.running:
+      return
+    self.running = False
+    if self.reader is None:
+      self.loop.remove_reader(self.ser.fileno())
+      if self.writing:
+        self.loop.remove_writer(self.ser.fileno())
+        self.writing = False
+    else:
+      self.reader.join()
+      self.writer.shutdown()
+    self.write_buffer.clear()
+    self.ser.close()
+    self._fail_pending(ConnectionError('connection closed'))
+
+  def _on_readable(self):
+    try:
+      data = self.ser.read(self.ser.in_waiting or 1)
+    except serial.SerialException as e:
+      logging.error('serial reader stopped: %s' % e)
+      self.close()
+      return
+    self._feed(data)
+
+  def _reader_loop(self):
+    while self.running:
+      try:
+        data = self.ser.read(self.ser.in_waiting or 1)
+      except serial.SerialException as e:
+        if self.running:
+          logging.error('serial reader stopped: %s' % e)
+          self.loop.call_soon_threadsafe(self.close)
+        return
+      if data:
+        self.loop.call_soon_threadsafe(self._feed, data)
+
+  def _feed(self, data):
+    self.decoder.feed(data)
+    for frame in self.decoder.frames():
+      self._dispatch(parse_frame(frame))
+
+  def _dispatch(self, msg):
+    if is_response(msg):
+      future = self.pending.pop(msg['i'], None)
+      if future and not future.done():
+        logging.debug('response: %s' % msg)
+        try:
+          future.set_result(response_result(msg))
+        except ConnectionError as e:
+          future.set_exception(e)
+        return
+    if not offer_event(self.event_queue, msg, self.max_events):
+      self.dropped_events += 1
+      logging.debug('event queue full, dropped status message')
+
+  def _fail_pending(self, error):
+    futures = list(self.pending.values())
+    self.pending.clear()
+    for future in futures:
+      if not future.done():
+        future.set_exception(error)
+    # wake up events() so it can finish
+    self.event_queue.put_nowait(None)
+
+  def _give_up(self, futures):
+    # requests that are not waited for any more, a late answer is treated like an event
+    for id in [id for id, future in self.pending.items() if future in futures]:
+      del self.pending[id]
+    for future in futures:
+      future.cancel()
+
+  async def events(self):
+    while True:
+      msg = await self.event_queue.get()
+      if msg is None:
+        return
+      yield msg
+
+  def send_request(self, name, params = {}):
+    if not self.running:
+      raise ConnectionError('connection closed')
+    future = self.loop.create_future()
+    id = random_id()
+    while id in self.pending:
+      id = random_id()
+    self.pending[id] = future
+    self._write(name, params, id)
+    return future
+
+  async def send_message(self, name, params = {}, expect_respose = True, timeout = None):
+    if (expect_respose):
+      future = self.send_request(name, params)
+      try:
+        return await asyncio.wait_for(future, timeout)
+      except asyncio.TimeoutError:
+        self._give_up([future])
+        raise
+    self._write(name, params, random_id())
+
+  def _write(self, name, params, id):
+    msg = {'m':name, 'p': params, 'i': id}
+    msg_string = json.dumps(msg)
+    logging.debug('sending: %s' % msg_string)
+    data = msg_string.encode('utf-8') + b'\x0D'
+    if self.writer is not None:
+      self.writer.submit(self.ser.write, data)
+      return
+    self.write_buffer += data
+    self._flush()
+
+  def _flush(self):
+    # writes what the port takes without blocking the event loop, the rest once it is writable again
+    try:
+      written = os.write(self.ser.fileno(), self.write_buffer)
+    except BlockingIOError:
+      written = 0
+    except OSError as e:
+      logging.error('serial writer stopped: %s' % e)
+      self.close()
+      return
+    del self.write_buffer[:written]
+    if self.write_buffer and not self.writing:
+      self.loop.add_writer(self.ser.fileno(), self._flush)
+      self.writing = True
+    elif not self.write_buffer and self.writing:
+      self.loop.remove_writer(self.ser.fileno())
+      self.writing = False
+
+  async def uploadProgram(self, file, to_slot, type = 'python', name = None, window = UPLOAD_WINDOW, manifest = None):
+    # with a manifest the upload is skipped (returning None) when the slot already holds this program
+    with open(file, "rb") as f:
+      data = f.read()
+    if manifest and manifest.is_current(to_slot, data, type, (await self.get_storage_information())['slots']):
+      print("Program in slot %d is unchanged, skipping upload" % to_slot)
+      return None
+    name = name if name else file
+    start_time = time.time()
+    try:
+      await self._upload(data, name, to_slot, type, window)
+    except ConnectionError as e:
+      if window <= 1:
+        raise
+      logging.warning('hub rejected pipelined upload (%s), retrying stop-and-wait' % e)
+      await self._upload(data, name, to_slot, type, 1)
+    rate = upload_rate(len(data), time.time() - start_time)
+    if manifest:
+      manifest.record(to_slot, data, type, (await self.get_storage_information())['slots'])
+    return rate
+
+  async def _upload(self, data, name, to_slot, type, window):
+    now = int(time.time() * 1000)
+    start = await self.start_write_program(name, len(data), to_slot, now, now, type)
+    id = start['transferid']
+    in_flight = collections.deque()
+    with tqdm(total=len(data), unit='B', unit_scale=True) as pbar:
+      try:
+        for size, block in encode_blocks(data, start['blocksize']):
+          # keep up to window write_package requests outstanding
+          if len(in_flight) >= window:
+            size, future = in_flight.popleft()
+            await future
+            pbar.update(size)
+          in_flight.append((size, self.send_request('write_package', {'data': block, 'transferid': id})))
+        while in_flight:
+          size, future = in_flight.popleft()
+          await future
+          pbar.update(size)
+      finally:
+        # let the hub answer what is still outstanding before the caller retries, a hub that dropped
+        # the blocks after a rejected one would otherwise be waited for forever
+        futures = [future for size, future in in_flight]
+        if futures:
+          await asyncio.wait(futures, timeout=UPLOAD_DRAIN_TIMEOUT)
+          self._give_up(futures)
+
+
 if __name__ == "__main__":
   def handle_list():
     info = rpc.get_storage_information()
@@ -189,25 +628,15 @@ if __name__ == "__main__":
     print("Firmware version: %s; Runtime version: %s" % (fw, rt))
   
   def handle_upload():
-    with open(args.file, "rb") as f:
-      size = os.path.getsize(args.file)
-      name = args.name if args.name else args.file
-      now = int(time.time() * 1000)
-      start = rpc.start_write_program(name, size, args.to_slot, now, now)
-      bs = start['blocksize']
-      id = start['transferid']
-      with tqdm(total=size, unit='B', unit_scale=True) as pbar:
-        b = f.read(bs)
-        while b:
-          rpc.write_package(b, id)
-          pbar.update(len(b))
-          b = f.read(bs)
-      if args.start:
-        rpc.program_execute(args.to_slot)
+    manifest = UploadManifest() if args.skip_unchanged else None
+    rpc.uploadProgram(args.file, args.to_slot, name=args.name, window=args.window, manifest=manifest)
+    if args.start:
+      rpc.program_execute(args.to_slot)
 
   parser = argparse.ArgumentParser(description='Tools for Spike Hub RPC protocol')
   parser.add_argument('-t', '--tty', help='Spike Hub device path', default='/dev/ttyACM0')
   parser.add_argument('--debug', help='Enable debug', action='store_true')
+  parser.add_argument('--direct', help='Open the hub directly instead of going through spike_daemon.py', action='store_true')
   parser.set_defaults(func=lambda: parser.print_help())
   sub_parsers = parser.add_subparsers()
 
@@ -227,6 +656,8 @@ if __name__ == "__main__":
   cpprogram_parser.add_argument('to_slot', type=int)
   cpprogram_parser.add_argument('name', nargs='?')
   cpprogram_parser.add_argument('--start', '-s', help='Start after upload', action='store_true')
+  cpprogram_parser.add_argument('--skip-unchanged', '-u', help='Skip the upload if the slot already holds this program', action='store_true')
+  cpprogram_parser.add_argument('--window', '-w', help='Blocks in flight during upload, 1 waits for each block', type=int, default=UPLOAD_WINDOW)
   cpprogram_parser.set_defaults(func=handle_upload)
 
   rmprogram_parser = sub_parsers.add_parser('rm', help='Removes the program at a given slot')
@@ -264,5 +695,7 @@ if __name__ == "__main__":
   args = parser.parse_args()
   if args.debug:
     logging.basicConfig(level=logging.DEBUG)
-  rpc = RPC(args.tty)
+  # reuse the daemon's open session when there is one
+  from spike_daemon import connect
+  rpc = connect(args.tty, args.direct)
   args.func()